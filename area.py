@@ -1,13 +1,23 @@
+from asgiref.sync import sync_to_async
 from django.db.models import F, Q, Value
 from django.db.models.functions import Concat
 
 from bolu.models.area import Village, Subdistrict
+from bolu.services.area_hierarchy import area_hierarchy_cache
+from bolu.services.area_search import area_search_index
 
 class AreaService:
-    """AreaService."""
+    """AreaService.
 
-    def get_custom_village(self, area):
+    Custom area lookups answer from the in memory area hierarchy unless
+    BOLU_AREA_CACHE is off or use_orm is passed.
+    """
+
+    def get_custom_village(self, area, use_orm=False):
         """Get custom area."""
+        if area_hierarchy_cache.enabled and not use_orm:
+            return area_hierarchy_cache.get().village_rows(area)
+
         return Village.objects.filter(Q(subdistrict__name=area) | Q(subdistrict__city__name=area))\
             .values(village_id=F("id"), subdistrict_name=F("subdistrict__name"),
             city=F("subdistrict__city__name"), province=F("subdistrict__city__province__name"))
@@ -18,14 +28,37 @@ class AreaService:
             .values(subdistrict_id=F("id"), subdistrict_name=F("name"), city_name=F("city__name"),
             province=F("city__province__name"))
 
-    def get_by_subdistrict(self, id):
+    async def aget_custom_subdistrict(self, area):
+        """Get custom subdistrict, async."""
+        return [subdistrict async for subdistrict in self.get_custom_subdistrict(area)]
+
+    def get_by_subdistrict(self, id, use_orm=False):
         """Get by subdistrict."""
+        if area_hierarchy_cache.enabled and not use_orm:
+            hierarchy = area_hierarchy_cache.get()
+            index = hierarchy.find_subdistrict(id)
+            return [hierarchy.subdistrict_row(index)] if index is not None else []
+
         return Subdistrict.objects.filter(Q(id=id))\
             .values(subdistrict_id=F("id"), subdistrict_name=F("name"), city_name=F("city__name"),
             province=F("city__province__name"))
 
-    def get_custom_area(self, area):
+    async def aget_by_subdistrict(self, id, use_orm=False):
+        """Get by subdistrict, async."""
+        if area_hierarchy_cache.enabled and not use_orm:
+            if area_hierarchy_cache.fresh:
+                return self.get_by_subdistrict(id)
+
+            # loading or checking the version reads the cache and database
+            return await sync_to_async(self.get_by_subdistrict)(id)
+
+        return [subdistrict async for subdistrict in self.get_by_subdistrict(id, use_orm=True)]
+
+    def get_custom_area(self, area, use_orm=False):
         """Get custom area."""
+        if area_hierarchy_cache.enabled and not use_orm:
+            return area_hierarchy_cache.get().village_rows(area, with_name=True)
+
         return Village.objects.filter(Q(subdistrict__name=area) | Q(subdistrict__city__name=area))\
             .values(village_id=F("id"), village=F("name"), subdistrict_name=F("subdistrict__name"),\
             city=F("subdistrict__city__name"), province=F("subdistrict__city__province__name"))
@@ -34,5 +67,9 @@ class AreaService:
         """Get City Subdistrict."""
         return Subdistrict.objects.select_related('city').filter(Q(name__icontains=keyword) | Q(city__name__icontains=keyword))
 
+    def search(self, keyword, limit=10, offset=0):
+        """Search subdistrict by area name from the in memory index."""
+        return area_search_index.search(keyword, limit, offset)
+
 
 area_service = AreaService()
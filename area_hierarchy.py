@@ -0,0 +1,255 @@
+"""Area hierarchy cache."""
+import os
+import pickle
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from bolu.models.area import City, Province, Subdistrict, Village
+from bolu.services.area_search import AreaSearchIndex
+
+
+class AreaHierarchy:
+    """Compact Province > City > Subdistrict > Village hierarchy.
+
+    Names and ids are kept in flat lists, parents as indexes in int
+    arrays, and children as offsets into index arrays sorted by parent.
+    """
+
+    __slots__ = (
+        'province_names',
+        'city_ids', 'city_names', 'city_province',
+        'subdistrict_ids', 'subdistrict_names', 'subdistrict_city',
+        'village_ids', 'village_names', 'village_subdistrict',
+        'city_subdistrict_offsets', 'city_subdistricts',
+        'subdistrict_village_offsets', 'subdistrict_villages',
+        'subdistrict_index', 'subdistricts_by_name', 'cities_by_name',
+    )
+
+    @classmethod
+    def from_database(cls):
+        """Build hierarchy with one query per area table."""
+        hierarchy = cls()
+        province_index = dict()
+        hierarchy.province_names = []
+
+        for province_id, name in Province.objects.values_list('id', 'name').iterator():
+            province_index[province_id] = len(hierarchy.province_names)
+            hierarchy.province_names.append(name)
+
+        city_index = dict()
+        hierarchy.city_ids, hierarchy.city_names, hierarchy.city_province = [], [], array('l')
+
+        for city_id, name, province_id in City.objects.values_list('id', 'name', 'province_id').iterator():
+            city_index[city_id] = len(hierarchy.city_ids)
+            hierarchy.city_ids.append(city_id)
+            hierarchy.city_names.append(name)
+            hierarchy.city_province.append(province_index.get(province_id, -1))
+
+        subdistrict_index = dict()
+        hierarchy.subdistrict_ids, hierarchy.subdistrict_names = [], []
+        hierarchy.subdistrict_city = array('l')
+
+        for subdistrict_id, name, city_id in Subdistrict.objects.values_list('id', 'name', 'city_id').iterator():
+            subdistrict_index[subdistrict_id] = len(hierarchy.subdistrict_ids)
+            hierarchy.subdistrict_ids.append(subdistrict_id)
+            hierarchy.subdistrict_names.append(name)
+            hierarchy.subdistrict_city.append(city_index.get(city_id, -1))
+
+        hierarchy.village_ids, hierarchy.village_names = [], []
+        hierarchy.village_subdistrict = array('l')
+        rows = Village.objects.values_list('id', 'name', 'subdistrict_id')
+
+        for village_id, name, subdistrict_id in rows.iterator():
+            hierarchy.village_ids.append(village_id)
+            hierarchy.village_names.append(name)
+            hierarchy.village_subdistrict.append(subdistrict_index.get(subdistrict_id, -1))
+
+        hierarchy.subdistrict_index = subdistrict_index
+        hierarchy.build_lookups()
+
+        return hierarchy
+
+    def build_lookups(self):
+        """Build children offsets and name lookups."""
+        self.city_subdistrict_offsets, self.city_subdistricts = self.group(
+            self.subdistrict_city, len(self.city_ids))
+        self.subdistrict_village_offsets, self.subdistrict_villages = self.group(
+            self.village_subdistrict, len(self.subdistrict_ids))
+
+        subdistricts_by_name = defaultdict(list)
+        cities_by_name = defaultdict(list)
+
+        for index, name in enumerate(self.subdistrict_names):
+            subdistricts_by_name[name].append(index)
+
+        for index, name in enumerate(self.city_names):
+            cities_by_name[name].append(index)
+
+        self.subdistricts_by_name = dict(subdistricts_by_name)
+        self.cities_by_name = dict(cities_by_name)
+
+    def group(self, parents, size):
+        """Get (offsets, children) of children grouped by parent index."""
+        offsets = array('l', [0] * (size + 1))
+
+        for parent in parents:
+            if parent >= 0:
+                offsets[parent + 1] += 1
+
+        for index in range(size):
+            offsets[index + 1] += offsets[index]
+
+        children = array('l', [0] * offsets[size])
+        position = array('l', offsets[:size])
+
+        for child, parent in enumerate(parents):
+            if parent >= 0:
+                children[position[parent]] = child
+                position[parent] += 1
+
+        return offsets, children
+
+    def children(self, offsets, children, parent):
+        """Get children indexes of a parent index."""
+        return children[offsets[parent]:offsets[parent + 1]]
+
+    def subdistricts_by_area(self, area):
+        """Get subdistrict indexes named area or in a city named area."""
+        indexes = set(self.subdistricts_by_name.get(area, ()))
+
+        for city in self.cities_by_name.get(area, ()):
+            indexes.update(self.children(self.city_subdistrict_offsets, self.city_subdistricts, city))
+
+        return sorted(indexes)
+
+    def subdistrict_row(self, index) -> dict:
+        """Get subdistrict row like AreaService subdistrict values."""
+        city = self.subdistrict_city[index]
+        province = self.city_province[city] if city >= 0 else -1
+
+        return {
+            'subdistrict_id': self.subdistrict_ids[index],
+            'subdistrict_name': self.subdistrict_names[index],
+            'city_name': self.city_names[city] if city >= 0 else None,
+            'province': self.province_names[province] if province >= 0 else None,
+        }
+
+    def village_rows(self, area, with_name=False) -> list:
+        """Get village rows of subdistricts named area or in a city named area."""
+        rows = []
+
+        for subdistrict in self.subdistricts_by_area(area):
+            subdistrict_row = self.subdistrict_row(subdistrict)
+
+            for village in self.children(self.subdistrict_village_offsets, self.subdistrict_villages, subdistrict):
+                row = {'village_id': self.village_ids[village]}
+
+                if with_name:
+                    row['village'] = self.village_names[village]
+
+                row['subdistrict_name'] = subdistrict_row['subdistrict_name']
+                row['city'] = subdistrict_row['city_name']
+                row['province'] = subdistrict_row['province']
+                rows.append(row)
+
+        return rows
+
+    def find_subdistrict(self, subdistrict_id):
+        """Get subdistrict index by id, accepting numeric strings."""
+        index = self.subdistrict_index.get(subdistrict_id)
+
+        if index is None and isinstance(subdistrict_id, str) and subdistrict_id.isdigit():
+            index = self.subdistrict_index.get(int(subdistrict_id))
+
+        return index
+
+
+class AreaHierarchyCache:
+    """Process wide AreaHierarchy.
+
+    Loaded from the BOLU_AREA_SNAPSHOT pickle when the setting points to an
+    existing file, otherwise from the database. Reloaded from the database
+    when the area search version changes, which every area model save or
+    delete bumps, checked at most every CHECK_INTERVAL seconds.
+    """
+
+    CHECK_INTERVAL = AreaSearchIndex.CHECK_INTERVAL
+    VERSION_KEY = AreaSearchIndex.VERSION_KEY
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hierarchy = None
+        self._version = None
+        self._checked_at = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether AreaService should answer from the hierarchy."""
+        return getattr(settings, 'BOLU_AREA_CACHE', True)
+
+    @property
+    def fresh(self) -> bool:
+        """Whether get returns the hierarchy without any cache or database read."""
+        return self._hierarchy is not None and time.monotonic() - self._checked_at < self.CHECK_INTERVAL
+
+    def get(self) -> AreaHierarchy:
+        """Get hierarchy, loading it on first use and reloading it when stale."""
+        now = time.monotonic()
+
+        if self._hierarchy is not None and now - self._checked_at < self.CHECK_INTERVAL:
+            return self._hierarchy
+
+        with self._lock:
+            version = cache.get(self.VERSION_KEY)
+
+            if self._hierarchy is None:
+                self._hierarchy = self.load()
+            elif version != self._version:
+                # the snapshot may be older than the change
+                self._hierarchy = AreaHierarchy.from_database()
+
+            self._version = version
+            self._checked_at = now
+
+        return self._hierarchy
+
+    def load(self) -> AreaHierarchy:
+        """Load hierarchy from snapshot or database."""
+        path = getattr(settings, 'BOLU_AREA_SNAPSHOT', None)
+
+        if path and os.path.exists(path):
+            with open(path, 'rb') as snapshot:
+                return pickle.load(snapshot)
+
+        return AreaHierarchy.from_database()
+
+    def save_snapshot(self, path):
+        """Write current database hierarchy to a pickle snapshot."""
+        hierarchy = AreaHierarchy.from_database()
+
+        with open(path, 'wb') as snapshot:
+            pickle.dump(hierarchy, snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return hierarchy
+
+    def reload(self, **kwargs):
+        """Check the version on the next call once the transaction commits."""
+        transaction.on_commit(self.expire)
+
+    def expire(self):
+        """Check the version on the next call."""
+        self._checked_at = 0
+
+
+area_hierarchy_cache = AreaHierarchyCache()
+
+for model in (Province, City, Subdistrict, Village):
+    post_save.connect(area_hierarchy_cache.reload, sender=model, dispatch_uid=f'area_hierarchy_{model.__name__}')
+    post_delete.connect(area_hierarchy_cache.reload, sender=model, dispatch_uid=f'area_hierarchy_{model.__name__}')
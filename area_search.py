@@ -0,0 +1,166 @@
+"""Area search index."""
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from bolu.models.area import City, Province, Subdistrict, Village
+
+
+class AreaSearchIndex:
+    """In memory trigram index over area names.
+
+    Every subdistrict is a record, searchable by its own, its villages,
+    its city and its province names. The index is built lazily with two
+    queries and rebuilt when an area model is saved or deleted in any
+    process, which is checked at most every CHECK_INTERVAL seconds.
+    """
+
+    CHECK_INTERVAL = 60
+    VERSION_KEY = 'area_search:version'
+
+    # field weights, lower ranks first
+    SUBDISTRICT = 0
+    CITY = 1
+    VILLAGE = 2
+    PROVINCE = 3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+        self._checked_at = 0
+
+    def normalize(self, text) -> str:
+        """Lowercase, strip accents and punctuation, collapse spaces."""
+        text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode()
+        return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text.lower()).split())
+
+    def trigrams(self, text):
+        """Get trigrams of normalized text."""
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def search(self, keyword, limit=10, offset=0) -> list:
+        """Get ranked subdistricts matching keyword.
+
+        Matching is substring like icontains, exact matches rank before
+        prefix, word prefix and inner matches.
+        """
+        query = self.normalize(keyword)
+
+        if not query:
+            return []
+
+        records, terms, sorted_terms, grams = self.get_index()
+
+        if len(query) < 3:
+            # too short for trigrams, only prefix matches
+            start = bisect.bisect_left(sorted_terms, query)
+            candidates = []
+
+            for term in sorted_terms[start:]:
+                if not term.startswith(query):
+                    break
+                candidates.append(term)
+        else:
+            postings = sorted((grams.get(gram, ()) for gram in self.trigrams(query)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+            candidates = [term for term in candidates if query in term]
+
+        best = dict()  # record, rank
+
+        for term in candidates:
+            if term == query:
+                match = 0
+            elif term.startswith(query):
+                match = 1
+            elif f' {query}' in term:
+                match = 2
+            else:
+                match = 3
+
+            for record, field in terms[term]:
+                rank = (match, field)
+
+                if record not in best or rank < best[record]:
+                    best[record] = rank
+
+        ranked = sorted(best, key=lambda record: (best[record], records[record]['subdistrict_name']))
+
+        return [records[record] for record in ranked[offset:offset + limit]]
+
+    def get_index(self):
+        """Get current index, rebuilding it when stale."""
+        now = time.monotonic()
+
+        if self._index is not None and now - self._checked_at < self.CHECK_INTERVAL:
+            return self._index
+
+        with self._lock:
+            version = cache.get(self.VERSION_KEY)
+
+            if self._index is None or version != self._version:
+                self._index = self.build()
+                self._version = version
+
+            self._checked_at = now
+
+        return self._index
+
+    def build(self):
+        """Build records, terms and trigram postings from the database."""
+        rows = Subdistrict.objects.values_list('id', 'name', 'city__name', 'city__province__name')
+        records = []
+        position = dict()
+        terms = defaultdict(list)  # term, [(record, field)]
+
+        for subdistrict_id, name, city, province in rows.iterator():
+            position[subdistrict_id] = len(records)
+            records.append({
+                'subdistrict_id': subdistrict_id,
+                'subdistrict_name': name,
+                'city_name': city,
+                'province': province,
+            })
+
+            for text, field in ((name, self.SUBDISTRICT), (city, self.CITY), (province, self.PROVINCE)):
+                terms[self.normalize(text)].append((position[subdistrict_id], field))
+
+        for subdistrict_id, name in Village.objects.values_list('subdistrict_id', 'name').iterator():
+            if subdistrict_id in position:
+                terms[self.normalize(name)].append((position[subdistrict_id], self.VILLAGE))
+
+        terms.pop('', None)
+        grams = defaultdict(list)
+
+        for term in terms:
+            for gram in self.trigrams(term):
+                grams[gram].append(term)
+
+        return records, dict(terms), sorted(terms), dict(grams)
+
+    def invalidate(self, **kwargs):
+        """Mark the index stale in every process once the transaction commits."""
+        transaction.on_commit(self.bump_version)
+
+    def bump_version(self):
+        """Bump shared index version and check it on the next search."""
+        self._checked_at = 0
+
+        try:
+            cache.incr(self.VERSION_KEY)
+        except ValueError:
+            cache.set(self.VERSION_KEY, time.time_ns(), None)
+
+
+area_search_index = AreaSearchIndex()
+
+for model in (Province, City, Subdistrict, Village):
+    post_save.connect(area_search_index.invalidate, sender=model, dispatch_uid=f'area_search_{model.__name__}')
+    post_delete.connect(area_search_index.invalidate, sender=model, dispatch_uid=f'area_search_{model.__name__}')
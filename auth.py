@@ -3,10 +3,9 @@ import uuid
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.utils import timezone
 
 from .otp import otp_service
-from .whatsapp import whatsapp_service
+from .otp_dispatch import otp_dispatcher
 
 User = get_user_model()
 
@@ -18,18 +17,15 @@ class AuthService:
         """Login user.
 
         Send whatsapp OTP
-        This function should be run async as it takes a while to send whatsapp
+        The message is queued to otp_dispatcher, sent_at and sent_status
+        are stored once it is sent.
         """
         user = User.objects.get(pk=user_id)
         token, flag = otp_service.get_login_token(user)
 
         message = settings.BOLU_OTP_LOGIN_TEMPLATE.format(code=token.code)
         to = str(user.whatsapp)
-        response = whatsapp_service.send_message(to, message)
-        token.sent_at = timezone.now()
-        token_status = otp_service.get_wa_send_message_status(response)
-        token.sent_status = token_status
-        token.save()
+        otp_dispatcher.enqueue(token, to, message)
 
         return token
 
@@ -0,0 +1,430 @@
+"""Benchmark service.
+
+Harnesses to measure the services against a local database, meant to be
+run from ``manage.py shell`` on a throwaway SQLite or PostgreSQL database.
+
+Regression suite::
+
+    benchmark_service.seed_areas()
+    benchmark_service.seed_orders(store, orders=10 ** 5)
+    results = benchmark_service.run_suite(store, user)
+    benchmark_service.write_results(results, 'bench.json')
+    benchmark_service.compare(results, 'bench_baseline.json')
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+import tracemalloc
+
+from django.db import connection, connections, transaction
+from rest_framework_simplejwt.tokens import AccessToken
+
+from bolu.models import Order, OrderItem, OTPToken, Product
+from bolu.models.area import City, Province, Subdistrict, Village
+from bolu.services.area import area_service
+from bolu.services.area_hierarchy import AreaHierarchy, area_hierarchy_cache
+from bolu.services.common import common_service
+from bolu.services.dashboard import dashboard_service
+from bolu.services.jwt import jwt_service
+from bolu.services.order import order_service
+from bolu.services.otp import otp_service
+from bolu.services.sequence import sequence_service
+from bolu.services.stock import stock_service
+
+
+class BenchmarkService:
+    """BenchmarkService."""
+
+    REGRESSION_TOLERANCE = 0.2
+
+    def run_threads(self, count, target) -> float:
+        """Run target in count threads, returns seconds until all finished."""
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        started = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return time.perf_counter() - started
+
+    def measure(self, run, repeat=5) -> dict:
+        """Time run and count its queries, best of repeat."""
+        timings = []
+        queries = 0
+
+        for _ in range(repeat):
+            counter = {'queries': 0}
+
+            def count_query(execute, sql, params, many, context):
+                counter['queries'] += 1
+                return execute(sql, params, many, context)
+
+            started = time.perf_counter()
+
+            with connection.execute_wrapper(count_query):
+                run()
+
+            timings.append(time.perf_counter() - started)
+            queries = max(queries, counter['queries'])
+
+        return {'best_seconds': min(timings), 'mean_seconds': sum(timings) / len(timings), 'queries': queries}
+
+    def hammer_stock(self, product_id, threads=16, attempts=100, qty=1) -> dict:
+        """Reserve one product from many threads at once.
+
+        Every thread tries to reserve ``qty`` ``attempts`` times. The product
+        is oversold if final stock is negative or does not match the number
+        of successful reservations.
+        """
+        start_quantity = Product.objects.values_list('quantity', flat=True).get(id=product_id)
+        counts = {'reserved': 0, 'short': 0, 'error': 0}
+        lock = threading.Lock()
+        barrier = threading.Barrier(threads)
+
+        def worker():
+            barrier.wait()
+            reserved = short = error = 0
+
+            try:
+                for _ in range(attempts):
+                    try:
+                        if stock_service.reserve({product_id: qty}).ok:
+                            reserved += 1
+                        else:
+                            short += 1
+                    except Exception:
+                        error += 1
+            finally:
+                connections.close_all()
+
+            with lock:
+                counts['reserved'] += reserved
+                counts['short'] += short
+                counts['error'] += error
+
+        elapsed = self.run_threads(threads, worker)
+        final_quantity = Product.objects.values_list('quantity', flat=True).get(id=product_id)
+        expected_quantity = start_quantity - counts['reserved'] * qty
+
+        return {
+            'threads': threads,
+            'attempts': threads * attempts,
+            'start_quantity': start_quantity,
+            'final_quantity': final_quantity,
+            'oversold': final_quantity < 0 or final_quantity != expected_quantity,
+            'seconds': elapsed,
+            'reservations_per_second': threads * attempts / elapsed if elapsed else 0,
+            **counts,
+        }
+
+    def allocate_order_numbers(self, store, workers=16, allocations=500, block=1) -> dict:
+        """Allocate order numbers for one store from parallel workers.
+
+        Duplicates count numbers handed out more than once.
+        """
+        numbers = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(workers)
+
+        def worker():
+            barrier.wait()
+            allocated = []
+
+            try:
+                for _ in range(allocations):
+                    allocated.extend(sequence_service.allocate(store, block))
+            finally:
+                connections.close_all()
+
+            with lock:
+                numbers.extend(allocated)
+
+        elapsed = self.run_threads(workers, worker)
+
+        return {
+            'workers': workers,
+            'allocations': workers * allocations,
+            'numbers': len(numbers),
+            'duplicates': len(numbers) - len(set(numbers)),
+            'seconds': elapsed,
+            'allocations_per_second': workers * allocations / elapsed if elapsed else 0,
+        }
+
+    def area_lookups(self, sample=200, repeat=5) -> dict:
+        """Compare area hierarchy lookups with the ORM querysets.
+
+        Lookups are get_custom_area and get_by_subdistrict over a sample of
+        subdistricts. Memory is what building the hierarchy allocates.
+        """
+        rows = list(Subdistrict.objects.values_list('id', 'name')[:sample])
+        tracemalloc.start()
+        hierarchy = AreaHierarchy.from_database()
+        hierarchy_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del hierarchy
+        area_hierarchy_cache.get()
+        results = {'sample': len(rows), 'hierarchy_bytes': hierarchy_bytes}
+
+        for name, use_orm in (('hierarchy', False), ('orm', True)):
+            lookups = 0
+            started = time.perf_counter()
+
+            for _ in range(repeat):
+                for subdistrict_id, subdistrict_name in rows:
+                    list(area_service.get_custom_area(subdistrict_name, use_orm=use_orm))
+                    list(area_service.get_by_subdistrict(subdistrict_id, use_orm=use_orm))
+                    lookups += 2
+
+            elapsed = time.perf_counter() - started
+            results[f'{name}_lookups_per_second'] = lookups / elapsed if elapsed else 0
+
+        return results
+
+    def legacy_format_rupiah(self, price):
+        """Recursive format_rupiah as it was, for comparison."""
+        price_str = str(int(price))
+
+        if len(price_str) <= 3:
+            return 'Rp ' + price_str
+
+        return self.legacy_format_rupiah(price_str[:-3]) + '.' + price_str[-3:]
+
+    def format_rupiah(self, count=1000000) -> dict:
+        """Time rupiah formatting of count prices per implementation."""
+        prices = [(i * 7919) % 250000000 for i in range(count)]
+        timings = {
+            'legacy': lambda: [self.legacy_format_rupiah(price) for price in prices],
+            'format_rupiah': lambda: [common_service.format_rupiah(price) for price in prices],
+            'format_rupiah_many': lambda: common_service.format_rupiah_many(prices),
+        }
+        results = {'count': count}
+
+        for name, run in timings.items():
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            results[f'{name}_seconds'] = elapsed
+            results[f'{name}_per_second'] = count / elapsed if elapsed else 0
+
+        return results
+
+    def jwt_verification(self, user, tokens=100, repeat=100) -> dict:
+        """Compare access token verification with and without the cache."""
+        access_tokens = [token['access'] for token in jwt_service.create_tokens_for_users([user] * tokens)]
+        timings = {
+            'uncached': lambda token: AccessToken(token),
+            'cached': jwt_service.verify_access_token,
+        }
+        results = {'tokens': tokens, 'verifications': tokens * repeat}
+
+        for name, verify in timings.items():
+            started = time.perf_counter()
+
+            for _ in range(repeat):
+                for token in access_tokens:
+                    verify(token)
+
+            elapsed = time.perf_counter() - started
+            results[f'{name}_per_second'] = tokens * repeat / elapsed if elapsed else 0
+
+        return results
+
+    def seed_areas(self, provinces=34, cities=514, subdistricts=7200, villages=83000, seed=0):
+        """Create a synthetic area hierarchy, Indonesian scale by default."""
+        rng = random.Random(seed)
+        syllables = ['ka', 'ma', 'ra', 'ta', 'su', 'ba', 'ja', 'ci', 'sen', 'gu', 'lo', 'ngan', 'wi', 'do']
+
+        def name(index):
+            return ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).title() + f' {index}'
+
+        with transaction.atomic():
+            province_rows = Province.objects.bulk_create([Province(name=name(i)) for i in range(provinces)])
+            city_rows = City.objects.bulk_create(
+                [City(name=name(i), province=province_rows[i % provinces]) for i in range(cities)])
+            subdistrict_rows = Subdistrict.objects.bulk_create(
+                [Subdistrict(name=name(i), city=city_rows[i % cities]) for i in range(subdistricts)],
+                batch_size=5000)
+            Village.objects.bulk_create(
+                [Village(name=name(i), subdistrict=subdistrict_rows[i % subdistricts]) for i in range(villages)],
+                batch_size=5000)
+
+    def seed_orders(self, store, orders=1000, products=200, max_items=5, seed=0, chunk_size=5000):
+        """Create synthetic products and orders with 1 to max_items items for store."""
+        rng = random.Random(seed)
+        statuses = [status.value for status in Order.OrderStatus]
+        product_rows = Product.objects.bulk_create([
+            Product(
+                store=store,
+                quantity=10 ** 6,
+                price=price,
+                selling_price=price + rng.randint(1, 50) * 500,
+                weight=rng.randint(50, 2000),
+            )
+            for price in (rng.randint(10, 1000) * 500 for _ in range(products))
+        ])
+
+        for offset in range(0, orders, chunk_size):
+            with transaction.atomic():
+                order_rows = Order.objects.bulk_create([
+                    Order(
+                        store=store,
+                        status=rng.choice(statuses),
+                        order_number=offset + i + 1,
+                        courier_price=rng.randint(5, 50) * 1000,
+                    )
+                    for i in range(min(chunk_size, orders - offset))
+                ])
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=product, qty=rng.randint(1, 5), price=product.selling_price)
+                    for order in order_rows
+                    for product in rng.sample(product_rows, rng.randint(1, max_items))
+                ], batch_size=chunk_size)
+
+        return product_rows
+
+    def update_order_items_queries(self, store, small=3, large=600) -> dict:
+        """Check update_order_items needs as many queries for small and large orders.
+
+        Each order keeps a third of its lines, changes a third, removes
+        the rest and adds as many new ones, inside a rolled back
+        transaction. The large order removes more than the 100 rows of a
+        collector delete batch. Raises AssertionError when the counts
+        differ.
+        """
+        queries = dict()
+
+        with transaction.atomic():
+            products = Product.objects.bulk_create([
+                Product(store=store, quantity=10 ** 6, price=500, selling_price=1000, weight=100)
+                for _ in range(large * 2)
+            ])
+
+            for size in (small, large):
+                order = Order.objects.create(store=store, status=Order.OrderStatus.DIKIRIM.value,
+                                             order_number=size, courier_price=0)
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=product, qty=2, price=product.selling_price)
+                    for product in products[:size]
+                ])
+                third = size // 3
+                items = [{'id': product.id, 'qty': 2} for product in products[:third]]
+                items += [{'id': product.id, 'qty': 3} for product in products[third:third * 2]]
+                items += [{'id': product.id, 'qty': 1} for product in products[size:size + third]]
+                queries[size] = self.measure(lambda: order_service.update_order_items(order, items), 1)['queries']
+
+            transaction.set_rollback(True)
+
+        if queries[small] != queries[large]:
+            raise AssertionError(f'update_order_items queries {queries[small]} for {small} lines, '
+                                 f'{queries[large]} for {large} lines')
+
+        return {'small': small, 'large': large, 'queries': queries[small]}
+
+    def run_suite(self, store, user, repeat=5, sample=100) -> dict:
+        """Time and count queries of the hot service calls on seeded data.
+
+        batch_update_status and update_order_items run inside a rolled back
+        transaction so every repeat sees the same data.
+        """
+        order_ids = list(Order.objects.filter(store=store).values_list('id', flat=True)[:sample])
+        order = Order.objects.filter(store=store).first()
+        items = [{'id': item.product_id, 'qty': item.qty + 1} for item in order.items.all()]
+        keyword = Subdistrict.objects.values_list('name', flat=True).first()[:4]
+        prices = list(range(0, 250000000, 2500))
+        otp_service.create_new_token(user, OTPToken.Event.LOGIN)
+
+        def rolled_back(run):
+            def wrapper():
+                with transaction.atomic():
+                    run()
+                    transaction.set_rollback(True)
+            return wrapper
+
+        calls = {
+            'batch_update_status': rolled_back(
+                lambda: order_service.batch_update_status(order_ids, Order.OrderStatus.DIKIRIM.value)),
+            'update_order_items': rolled_back(lambda: order_service.update_order_items(order, items)),
+            'get_total_payment': lambda: order_service.get_total_payment(store, None),
+            'get_custom_subdistrict': lambda: list(area_service.get_custom_subdistrict(keyword)),
+            'get_valid_unverified_token': lambda: otp_service.get_valid_unverified_token(
+                user, OTPToken.Event.LOGIN),
+            'format_rupiah': lambda: common_service.format_rupiah_many(prices),
+        }
+
+        return {
+            'orders': Order.objects.filter(store=store).count(),
+            'calls': {name: self.measure(run, repeat) for name, run in calls.items()},
+            'update_order_items_queries': self.update_order_items_queries(store),
+        }
+
+    def write_results(self, results, path):
+        """Write suite results as JSON."""
+        with open(path, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    def compare(self, results, baseline_path, tolerance=REGRESSION_TOLERANCE) -> list:
+        """Get regressions against a baseline JSON, empty when none.
+
+        A call regresses when it needs more queries or its best time is
+        slower than baseline by more than tolerance.
+        """
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)['calls']
+
+        regressions = []
+
+        for name, current in results['calls'].items():
+            previous = baseline.get(name)
+
+            if not previous:
+                continue
+
+            if current['queries'] > previous['queries']:
+                regressions.append(f"{name}: queries {previous['queries']} -> {current['queries']}")
+
+            if current['best_seconds'] > previous['best_seconds'] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: best {previous['best_seconds']:.4f}s -> {current['best_seconds']:.4f}s")
+
+        return regressions
+
+    def dashboard_load(self, store, requests=200, concurrency=50) -> dict:
+        """Compare dashboard throughput of one worker, sync vs async.
+
+        Sync serves requests one after another, async keeps up to
+        concurrency aget_dashboard calls in flight on one event loop.
+        """
+        started = time.perf_counter()
+
+        for _ in range(requests):
+            dashboard_service.get_dashboard(store)
+
+        sync_elapsed = time.perf_counter() - started
+
+        async def load():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def request():
+                async with semaphore:
+                    await dashboard_service.aget_dashboard(store)
+
+            await asyncio.gather(*(request() for _ in range(requests)))
+
+        started = time.perf_counter()
+        asyncio.run(load())
+        async_elapsed = time.perf_counter() - started
+
+        return {
+            'requests': requests,
+            'concurrency': concurrency,
+            'sync_per_second': requests / sync_elapsed if sync_elapsed else 0,
+            'async_per_second': requests / async_elapsed if async_elapsed else 0,
+        }
+
+
+benchmark_service = BenchmarkService()
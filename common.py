@@ -1,36 +1,121 @@
 """Common service module."""
+from decimal import Decimal, ROUND_HALF_UP
+import uuid
+
 from .user import user_service
 from django.conf import settings
 from django.core import signing
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RUPIAH_SEPARATORS = str.maketrans(',.', '.,')
+
+
 class CommonService:
     """Common service."""
 
     def create_confirmation_sign(self, email, confirmation_code_id):
         """Create Encrypted message to confirmation email."""
         user = user_service.get_by_email(email)
-        user_id = user.id.hex
+        return self.sign_confirmation(user.id.hex, confirmation_code_id)
+
+    def sign_confirmation(self, user_id, confirmation_code_id):
+        """Sign (user id hex, confirmation code id) as token:salt_index."""
         payload = (user_id, confirmation_code_id,)
 
         # Set salt
-        salts = settings.BOLU_SALTS
-        last_char_ascii = ord(user_id[-1])
-        salt_index = last_char_ascii % len(salts)
-        salt = salts[salt_index]
+        salt_index = self.get_salt_index(user_id)
+        signer = self.get_signers()[salt_index]
 
-        token = signing.dumps(payload, salt=salt)
+        token = signer.sign_object(payload)
         token = f'{token}:{salt_index}'
         return token
 
-    def format_rupiah(self, price):
-        price_int = int(price)
-        price_str = str(price_int)
-        if len(price_str) <= 3 :
-            return 'Rp ' + price_str     
-        else :
-            p = price_str[-3:]
-            q = price_str[:-3]
-            return self.format_rupiah(q) + '.' + p
+    def create_confirmation_signs(self, users, confirmation_code_ids):
+        """Create confirmation tokens for many users without user lookups.
+
+        users are User instances or ids, paired with confirmation_code_ids.
+        Signers are built once, so signing is a plain HMAC per token.
+        """
+        return [
+            self.sign_confirmation(self.get_user_id_hex(user), confirmation_code_id)
+            for user, confirmation_code_id in zip(users, confirmation_code_ids)
+        ]
+
+    def load_confirmation_sign(self, token, max_age=None):
+        """Get (user id hex, confirmation code id) from a confirmation token.
+
+        The salt index suffix picks the signer, raises signing.BadSignature
+        when the token is invalid.
+        """
+        token, _, salt_index = token.rpartition(':')
+        signers = self.get_signers()
+
+        if not salt_index.isdigit() or int(salt_index) >= len(signers):
+            raise signing.BadSignature('Unknown salt index')
+
+        user_id, confirmation_code_id = signers[int(salt_index)].unsign_object(token, max_age=max_age)
+        return user_id, confirmation_code_id
+
+    def get_user_id_hex(self, user):
+        """Get id hex of a User, UUID or UUID string."""
+        user_id = getattr(user, 'id', user)
+
+        if not isinstance(user_id, uuid.UUID):
+            user_id = uuid.UUID(str(user_id))
+
+        return user_id.hex
+
+    def get_salt_index(self, user_id):
+        """Pick salt index by last char of user id hex."""
+        last_char_ascii = ord(user_id[-1])
+        return last_char_ascii % len(settings.BOLU_SALTS)
+
+    def get_signers(self):
+        """Get one TimestampSigner per salt, built once per salts setting."""
+        salts = tuple(settings.BOLU_SALTS)
+
+        if getattr(self, '_signers_salts', None) != salts:
+            self._signers = [signing.TimestampSigner(salt=salt) for salt in salts]
+            self._signers_salts = salts
+
+        return self._signers
+
+    def format_rupiah(self, price, decimals=0):
+        """Format price as rupiah, e.g. Rp 1.250.000 or Rp -1.250,50.
+
+        Accepts int, float, str and Decimal, rounding half up to decimals.
+        """
+        amount = price if isinstance(price, Decimal) else Decimal(str(price))
+        amount = amount.quantize(Decimal(1).scaleb(-decimals), rounding=ROUND_HALF_UP)
+        sign = '-' if amount < 0 else ''
+
+        return f'Rp {sign}{abs(amount):,.{decimals}f}'.translate(RUPIAH_SEPARATORS)
+
+    def format_rupiah_many(self, prices, decimals=0):
+        """Format a column of prices in one pass.
+
+        Whole rupiah int / float columns are rounded with NumPy when it is
+        installed.
+        """
+        prices = list(prices)
+
+        if numpy is not None and decimals == 0 and prices:
+            values = numpy.asarray(prices)
+
+            if values.dtype.kind in 'iuf':
+                # round half away from zero like ROUND_HALF_UP
+                values = numpy.sign(values) * numpy.floor(numpy.abs(values) + 0.5)
+                return [
+                    f'Rp -{-value:,}'.translate(RUPIAH_SEPARATORS) if value < 0
+                    else f'Rp {value:,}'.translate(RUPIAH_SEPARATORS)
+                    for value in values.astype(numpy.int64).tolist()
+                ]
+
+        return [self.format_rupiah(price, decimals) for price in prices]
 
 
 common_service = CommonService()
@@ -1,18 +1,107 @@
 """Config service."""
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+
 from bolu.models import Config
 
 
 class ConfigService:
-    """ConfigService."""
+    """ConfigService.
+
+    Values are cached in two tiers, a per process dict kept for LOCAL_TTL
+    seconds and the shared cache. Shared entries are keyed by a version
+    which every write bumps, so a write invalidates all processes at once
+    and they pick it up when their local entries expire.
+    """
+
+    LOCAL_TTL = 30
+    SHARED_TIMEOUT = 60 * 60
+    VERSION_KEY = 'config:version'
+
+    def __init__(self):
+        self._local = dict()  # key, (found, value, expires at)
 
     def get(self, key, default_value=None):
         """Get config."""
-        config = Config.objects.filter(key=key).first()
+        return self.get_many([key]).get(key, default_value)
 
-        if config:
-            return config.value
-        else:
-            return default_value
+    async def aget(self, key, default_value=None):
+        """Get config, async.
+
+        Local tier hits return without leaving the event loop.
+        """
+        local = self._local.get(key)
+
+        if local and local[2] > time.monotonic():
+            return local[1] if local[0] else default_value
+
+        values = await sync_to_async(self.get_many)([key])
+        return values.get(key, default_value)
+
+    def get_many(self, keys) -> dict:
+        """Get {key: value} of existing configs, with one query at most."""
+        now = time.monotonic()
+        values = dict()
+        missing = []
+
+        for key in keys:
+            local = self._local.get(key)
+
+            if local and local[2] > now:
+                if local[0]:
+                    values[key] = local[1]
+            else:
+                missing.append(key)
+
+        if not missing:
+            return values
+
+        version = self.get_version()
+        shared = cache.get_many([self.shared_key(version, key) for key in missing])
+        loaded = dict()
+
+        for key in missing:
+            entry = shared.get(self.shared_key(version, key))
+
+            if entry is not None:
+                loaded[key] = entry
+
+        unloaded = [key for key in missing if key not in loaded]
+
+        if unloaded:
+            configs = dict(Config.objects.filter(key__in=unloaded).values_list('key', 'value'))
+            fetched = {key: (key in configs, configs.get(key)) for key in unloaded}
+            cache.set_many(
+                {self.shared_key(version, key): entry for key, entry in fetched.items()},
+                self.SHARED_TIMEOUT,
+            )
+            loaded.update(fetched)
+
+        for key, (found, value) in loaded.items():
+            self._local[key] = (found, value, now + self.LOCAL_TTL)
+
+            if found:
+                values[key] = value
+
+        return values
+
+    def warm(self):
+        """Load every config into both cache tiers with one query."""
+        configs = dict(Config.objects.values_list('key', 'value'))
+        version = self.get_version()
+        expires_at = time.monotonic() + self.LOCAL_TTL
+        cache.set_many(
+            {self.shared_key(version, key): (True, value) for key, value in configs.items()},
+            self.SHARED_TIMEOUT,
+        )
+
+        for key, value in configs.items():
+            self._local[key] = (True, value, expires_at)
+
+        return configs
 
     def set(self, key, value, description=''):
         """Set config.
@@ -20,7 +109,7 @@ class ConfigService:
         Create if not exists
         otherwise update
         """
-        config = self.get(key)
+        config = Config.objects.filter(key=key).first()
 
         if not config:
             config = Config.objects.create(key=key, value=value, description=description)
@@ -32,16 +121,48 @@ class ConfigService:
 
             config.save()
 
+        self.invalidate()
         return config
 
     def set_if_none(self, key, value, description=''):
         """Add config only if not exist."""
-        config = self.get(key)
+        config, created = Config.objects.get_or_create(
+            key=key,
+            defaults={'value': value, 'description': description},
+        )
 
-        if not config:
-            config = Config.objects.create(key=key, value=value, description=description)
+        if created:
+            self.invalidate()
 
         return config
 
+    def invalidate(self):
+        """Drop cached configs in every process once the transaction commits."""
+        transaction.on_commit(self.bump_version)
+
+    def bump_version(self):
+        """Bump shared cache version and clear local configs."""
+        self._local.clear()
+
+        try:
+            cache.incr(self.VERSION_KEY)
+        except ValueError:
+            cache.set(self.VERSION_KEY, time.time_ns(), None)
+
+    def get_version(self):
+        """Get current shared cache version."""
+        version = cache.get(self.VERSION_KEY)
+
+        if version is None:
+            # never restart from an old version after eviction
+            cache.add(self.VERSION_KEY, time.time_ns(), None)
+            version = cache.get(self.VERSION_KEY)
+
+        return version
+
+    def shared_key(self, version, key):
+        """Get shared cache key of a config."""
+        return f'config:{version}:{key}'
+
 
 config_service = ConfigService()
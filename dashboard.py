@@ -0,0 +1,27 @@
+"""Dashboard service."""
+from bolu.services.statistic import statistic_service
+
+
+class DashboardService:
+    """DashboardService.
+
+    Metrics are summed from the StatisticService daily rollup, so a
+    dashboard read costs O(days) whatever the number of orders.
+    aget_dashboard runs it off the event loop, so under ASGI other
+    requests are served while its queries run.
+    """
+
+    async def aget_dashboard(self, store, month=None) -> dict:
+        """Get store dashboard metrics, async."""
+        return await statistic_service.aget_dashboard(store, *self.month_range(month))
+
+    def get_dashboard(self, store, month=None) -> dict:
+        """Get store dashboard metrics."""
+        return statistic_service.get_dashboard(store, *self.month_range(month))
+
+    def month_range(self, month) -> tuple:
+        """Get [start, end) dates of month this year, all time without month."""
+        return statistic_service.month_range(month) if month is not None else ()
+
+
+dashboard_service = DashboardService()
@@ -0,0 +1,211 @@
+"""Service instrumentation."""
+import bisect
+import functools
+import importlib
+import inspect
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+SERVICES = (
+    ('bolu.services.order', 'order_service'),
+    ('bolu.services.otp', 'otp_service'),
+    ('bolu.services.area', 'area_service'),
+    ('bolu.services.config', 'config_service'),
+    ('bolu.services.product', 'product_service'),
+    ('bolu.services.auth', 'auth_service'),
+    ('bolu.services.registration', 'registration_service'),
+    ('bolu.services.jwt', 'jwt_service'),
+    ('bolu.services.common', 'common_service'),
+)
+
+
+class Histogram:
+    """Fixed bucket histogram."""
+
+    __slots__ = ('bounds', 'buckets', 'count', 'total', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        """Add a value."""
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Get upper bound of the bucket holding quantile q."""
+        if not self.count:
+            return 0
+
+        rank = q * self.count
+        seen = 0
+
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+
+            if seen >= rank:
+                return bound
+
+        return self.max
+
+    def as_dict(self) -> dict:
+        """Get summary of the histogram."""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+class ServiceInstrumentation:
+    """Opt in wall time, query count and query time per service call.
+
+    instrument_all wraps every public method of the service singletons,
+    enabled from an AppConfig.ready when BOLU_SERVICE_METRICS is set.
+    Calls over BOLU_SERVICE_QUERY_BUDGET queries or
+    BOLU_SERVICE_LATENCY_BUDGET_MS milliseconds are logged.
+    """
+
+    TIME_BOUNDS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # ms
+    QUERY_BOUNDS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = dict()  # (service, method), {wall_ms, queries, db_ms}
+        self._originals = dict()  # (service, method), original bound method
+
+    def instrument_all(self, force=False):
+        """Wrap every service singleton when metrics are enabled."""
+        if not (force or getattr(settings, 'BOLU_SERVICE_METRICS', False)):
+            return
+
+        for module_path, name in SERVICES:
+            self.instrument(getattr(importlib.import_module(module_path), name), name)
+
+    def instrument(self, service, name):
+        """Wrap public methods of a service instance."""
+        for attribute, method in inspect.getmembers(service, inspect.ismethod):
+            if attribute.startswith('_') or (name, attribute) in self._originals:
+                continue
+
+            if inspect.isgeneratorfunction(method) or inspect.iscoroutinefunction(method):
+                continue  # timing would only cover creating the generator / coroutine
+
+            self._originals[(name, attribute)] = method
+            setattr(service, attribute, self.wrap(method, name, attribute))
+
+    def uninstrument(self):
+        """Restore original methods."""
+        for module_path, name in SERVICES:
+            service = getattr(importlib.import_module(module_path), name)
+
+            for (service_name, attribute) in list(self._originals):
+                if service_name == name:
+                    del self._originals[(service_name, attribute)]
+                    service.__dict__.pop(attribute, None)
+
+    def wrap(self, method, name, attribute):
+        """Get method wrapper recording its metrics."""
+        key = (name, attribute)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            stats = {'queries': 0, 'db': 0.0}
+
+            def count_query(execute, sql, params, many, context):
+                started = time.perf_counter()
+
+                try:
+                    return execute(sql, params, many, context)
+                finally:
+                    stats['queries'] += 1
+                    stats['db'] += time.perf_counter() - started
+
+            started = time.perf_counter()
+
+            try:
+                with connection.execute_wrapper(count_query):
+                    return method(*args, **kwargs)
+            finally:
+                wall_ms = (time.perf_counter() - started) * 1000
+                self.record(key, wall_ms, stats['queries'], stats['db'] * 1000)
+
+        return wrapper
+
+    def record(self, key, wall_ms, queries, db_ms):
+        """Add one call to the histograms and check budgets."""
+        with self._lock:
+            metrics = self._metrics.get(key)
+
+            if metrics is None:
+                metrics = self._metrics[key] = {
+                    'wall_ms': Histogram(self.TIME_BOUNDS),
+                    'queries': Histogram(self.QUERY_BOUNDS),
+                    'db_ms': Histogram(self.TIME_BOUNDS),
+                }
+
+            metrics['wall_ms'].observe(wall_ms)
+            metrics['queries'].observe(queries)
+            metrics['db_ms'].observe(db_ms)
+
+        query_budget = getattr(settings, 'BOLU_SERVICE_QUERY_BUDGET', None)
+        latency_budget = getattr(settings, 'BOLU_SERVICE_LATENCY_BUDGET_MS', None)
+
+        if (query_budget is not None and queries > query_budget) or \
+                (latency_budget is not None and wall_ms > latency_budget):
+            logger.warning('Service call over budget %s.%s %.1f ms %d queries %.1f ms db',
+                           key[0], key[1], wall_ms, queries, db_ms)
+
+    def snapshot(self) -> dict:
+        """Get {'service.method': {metric: summary}}."""
+        with self._lock:
+            return {
+                f'{service}.{method}': {name: histogram.as_dict() for name, histogram in metrics.items()}
+                for (service, method), metrics in self._metrics.items()
+            }
+
+    def reset(self):
+        """Drop recorded metrics."""
+        with self._lock:
+            self._metrics.clear()
+
+    def dump(self) -> str:
+        """Get metrics as plain text, one line per call and metric."""
+        lines = []
+
+        for call, metrics in sorted(self.snapshot().items()):
+            for name, summary in metrics.items():
+                values = ' '.join(f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}'
+                                  for key, value in summary.items())
+                lines.append(f'{call} {name} {values}')
+
+        return '\n'.join(lines) + '\n'
+
+
+service_instrumentation = ServiceInstrumentation()
+
+
+def metrics_view(request):
+    """Plain text service metrics, for staff only."""
+    if not request.user.is_staff:
+        return HttpResponse(status=403)
+
+    return HttpResponse(service_instrumentation.dump(), content_type='text/plain')
@@ -1,10 +1,20 @@
 """JWT service."""
+from collections import OrderedDict
+import hashlib
 import logging
+import threading
+import time
 
+from django.apps import apps
 from django.contrib.auth import (
     get_user_model,
 )
-from rest_framework_simplejwt.tokens import RefreshToken
+from django.core.cache import cache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, BlacklistMixin, RefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
 
 from .otp import otp_service
 from .user import user_service
@@ -14,7 +24,26 @@ User = get_user_model()
 
 
 class JWTService:
-    """JWTService."""
+    """JWTService.
+
+    Verified access tokens are kept in a bounded LRU keyed by the token
+    digest until they expire, so a token signature is checked once per
+    process. Revoked token ids are kept in the shared cache until the
+    token would have expired, and every revocation bumps a shared
+    version. Processes read that version at most every
+    REVOCATION_CHECK_INTERVAL seconds and only look a cached token up in
+    the denylist again when the version changed since its last check.
+    """
+
+    VERIFIED_CACHE_SIZE = 10000
+    REVOCATION_CHECK_INTERVAL = 5
+    REVOCATION_VERSION_KEY = 'jwt:revoked:version'
+
+    def __init__(self):
+        self._verified = OrderedDict()  # token digest, [AccessToken, revocation version checked]
+        self._lock = threading.Lock()
+        self._revocation_version = None
+        self._revocation_checked_at = 0
 
     def create_token_for_user(self, user: User) -> dict:
         """Manually create JWT Token."""
@@ -24,8 +53,133 @@ class JWTService:
             'access': str(refresh.access_token),
         }
 
-    def confirm_token(self, whatsapp: str, token: str) -> object:
-        """Confirm token on registration."""
+    def create_tokens_for_users(self, users) -> list:
+        """Create JWT Tokens for many users, e.g. service provisioning.
+
+        Refresh tokens are built without per token queries. With the
+        simplejwt token_blacklist app installed their OutstandingToken
+        rows are inserted with one bulk query.
+        """
+        users = list(users)
+        # skip BlacklistMixin.for_user, which inserts one OutstandingToken per call
+        refresh_tokens = [super(BlacklistMixin, RefreshToken).for_user(user) for user in users]
+        tokens = [
+            {'refresh': str(refresh), 'access': str(refresh.access_token)}
+            for refresh in refresh_tokens
+        ]
+
+        if apps.is_installed('rest_framework_simplejwt.token_blacklist'):
+            from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+
+            OutstandingToken.objects.bulk_create([
+                OutstandingToken(
+                    user=user,
+                    jti=refresh[api_settings.JTI_CLAIM],
+                    token=token['refresh'],
+                    created_at=refresh.current_time,
+                    expires_at=datetime_from_epoch(refresh['exp']),
+                )
+                for user, refresh, token in zip(users, refresh_tokens, tokens)
+            ])
+
+        return tokens
+
+    def verify_access_token(self, token) -> AccessToken:
+        """Get verified AccessToken, raises TokenError when invalid or revoked."""
+        digest = self.token_digest(token)
+        version = self.get_revocation_version()
+        now = time.time()
+
+        with self._lock:
+            entry = self._verified.get(digest)
+
+            if entry is not None:
+                if entry[0]['exp'] > now:
+                    self._verified.move_to_end(digest)
+                else:
+                    del self._verified[digest]
+                    entry = None
+
+        if entry is None:
+            entry = [AccessToken(token.decode() if isinstance(token, bytes) else token), None]
+
+            with self._lock:
+                self._verified[digest] = entry
+
+                while len(self._verified) > self.VERIFIED_CACHE_SIZE:
+                    self._verified.popitem(last=False)
+
+        if entry[1] != version:
+            if cache.get(self.revoked_key(entry[0][api_settings.JTI_CLAIM])):
+                with self._lock:
+                    self._verified.pop(digest, None)
+
+                raise TokenError('Token is revoked')
+
+            entry[1] = version
+
+        return entry[0]
+
+    def get_revocation_version(self):
+        """Get shared revocation version, read at most every REVOCATION_CHECK_INTERVAL."""
+        now = time.monotonic()
+
+        if self._revocation_version is None or now - self._revocation_checked_at >= self.REVOCATION_CHECK_INTERVAL:
+            version = cache.get(self.REVOCATION_VERSION_KEY)
+
+            if version is None:
+                # never restart from an old version after eviction
+                cache.add(self.REVOCATION_VERSION_KEY, time.time_ns(), None)
+                version = cache.get(self.REVOCATION_VERSION_KEY)
+
+            self._revocation_version = version
+            self._revocation_checked_at = now
+
+        return self._revocation_version
+
+    def revoke_token(self, token):
+        """Deny a token until it expires, in every process."""
+        access_token = AccessToken(token)
+        timeout = int(access_token['exp'] - time.time()) + 1
+
+        if timeout > 0:
+            cache.set(self.revoked_key(access_token[api_settings.JTI_CLAIM]), True, timeout)
+
+            try:
+                cache.incr(self.REVOCATION_VERSION_KEY)
+            except ValueError:
+                cache.set(self.REVOCATION_VERSION_KEY, time.time_ns(), None)
+
+        with self._lock:
+            self._verified.pop(self.token_digest(token), None)
+
+        self._revocation_checked_at = 0
+
+    def token_digest(self, token):
+        """Get verified token cache key of a token."""
+        if isinstance(token, bytes):
+            token = token.decode()
+
+        return hashlib.sha256(token.encode()).digest()
+
+    def revoked_key(self, jti):
+        """Get cache key of a revoked token id."""
+        return f'jwt:revoked:{jti}'
+
+    def confirm_token(self, whatsapp: str, token: str, ip: str = None) -> object:
+        """Confirm token on registration.
+
+        Checked against the cached pending token first, the database is
+        only read when nothing is cached for the number.
+        """
+        result, user_id = otp_service.verify_cached_token(whatsapp, token, ip)
+
+        if result == otp_service.VERIFY_VALID:
+            return True
+        elif result != otp_service.VERIFY_MISS:
+            logger.warn('Invalid token %s %s', whatsapp, token)
+            return False
+
         user = user_service.get_by_whatsapp(whatsapp)
 
         if user:
@@ -43,3 +197,14 @@ class JWTService:
 
 
 jwt_service = JWTService()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication verifying access tokens through jwt_service."""
+
+    def get_validated_token(self, raw_token):
+        """Get validated token from the verified token cache."""
+        try:
+            return jwt_service.verify_access_token(raw_token)
+        except TokenError as e:
+            raise InvalidToken({'detail': str(e), 'messages': []})
@@ -1,110 +1,184 @@
 """Order service."""
-from django.utils import dateformat, timezone
-from django.db.models import F, FloatField, PositiveIntegerField, Sum
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import F, PositiveIntegerField, Sum
+from django.db.models.signals import post_delete, post_save
 
 from bolu.models import Order, OrderCancelReason, OrderItem, Product
 from bolu.services.common import common_service
+from bolu.services.sequence import sequence_service
+from bolu.services.statistic import statistic_service
+from bolu.services.stock import stock_service
 
 
 class OrderService:
     """OrderService."""
 
-    def batch_update_status(self, order_ids, status):
-        """Update status of multiple orders."""
-        cancel_status = Order.OrderStatus.DIBATALKAN.value
+    SUMMARY_TIMEOUT = 60 * 60 * 24
+    BULK_BATCH_SIZE = 1000
 
-        orders = Order.objects.filter(id__in=order_ids)
-        # update = orders.update(status=status)
+    def batch_update_status(self, order_ids, status):
+        """Update status of multiple orders.
 
+        Items and products are loaded in a fixed number of queries, stock
+        changes are accumulated per product in memory and written back in
+        one transaction.
+        """
+        cancel_status = Order.OrderStatus.DIBATALKAN.value
+        done_status = Order.OrderStatus.SELESAI.value
         transaction_statuses = dict()
 
-        for order in orders:
-            current_status = order.status
-            trx_status = True
-
-            # if submit cancelation and current order status is not canceled
-            if status == cancel_status and current_status != cancel_status:
-                trx_status = self.revert_order_product_stock(order)
-
-            # if submit status change from cancel to anything
-            elif current_status == cancel_status:
-                trx_status = self.aquire_order_product_stock(order)
+        with transaction.atomic():
+            orders = Order.objects.select_for_update().filter(id__in=order_ids)\
+                .order_by('id').prefetch_related('items')
+            orders = list(orders)
+            product_ids = {item.product_id for order in orders for item in order.items.all()}
+            products = Product.objects.select_for_update().filter(id__in=product_ids).order_by('id')
+            products = {product.id: product for product in products}
+            updated_order_ids = []
+            updated_product_ids = set()
+
+            for order in orders:
+                current_status = order.status
+                order_items = order.items.all()
+                trx_status = True
+
+                # if submit cancelation and current order status is not canceled
+                if status == cancel_status and current_status != cancel_status:
+                    trx_status = self._revert_stock(order_items, products)
+
+                # if submit status change from cancel to anything
+                elif current_status == cancel_status:
+                    trx_status = self._aquire_stock(order_items, products)
+
+                transaction_statuses[str(order.id)] = trx_status
+
+                if trx_status:
+                    updated_order_ids.append(order.id)
+                    updated_product_ids.update(item.product_id for item in order_items)
+
+            if updated_product_ids:
+                Product.objects.bulk_update([products[pk] for pk in sorted(updated_product_ids)], ['quantity'])
+
+            if updated_order_ids:
+                # completed orders moved in or out of the daily rollup
+                updated = set(updated_order_ids)
+                statistic_service.invalidate_orders(
+                    order for order in orders
+                    if order.id in updated and done_status in (status, order.status)
+                )
+                fields = {'status': status}
+                date_field = self.get_status_date_field(status)
 
-            transaction_statuses[str(order.id)] = trx_status
+                if date_field:
+                    fields[date_field] = timezone.now()
 
-            if trx_status:
-                order = self.update_status_date(order, status)
-                order.status = status
-                order.save()
+                Order.objects.filter(id__in=updated_order_ids).update(**fields)
+                self.invalidate_summaries(updated_order_ids)
 
         return transaction_statuses
 
-    def revert_order_product_stock(self, order):
-        """Update product stock if order is canceled."""
-        order_items = order.items.all()
-
+    def _revert_stock(self, order_items, products):
+        """Give order items quantity back to in memory products."""
         for item in order_items:
-            product = item.product
+            product = products[item.product_id]
             product.quantity = product.quantity + item.qty
-            product.save()
 
         return True
 
-    def aquire_order_product_stock(self, order):
-        """Take stock from product to order item."""
-        order_items = order.items.all()
-        product_container = list()
+    def _aquire_stock(self, order_items, products):
+        """Take order items quantity from in memory products.
+
+        Nothing is taken unless every product has enough stock.
+        """
+        needed = defaultdict(int)
 
         for item in order_items:
-            # check if product quantity can be aquired by order items
-            product = item.product
+            needed[item.product_id] += item.qty
 
-            if product.quantity < item.qty:
+        for product_id, qty in needed.items():
+            if products[product_id].quantity < qty:
                 return False
 
-            product.quantity = product.quantity - item.qty
-            product_container.append(product)
+        for product_id, qty in needed.items():
+            product = products[product_id]
+            product.quantity = product.quantity - qty
 
-        for product in product_container:
-            product.save()
+        return True
+
+    def revert_order_product_stock(self, order):
+        """Update product stock if order is canceled."""
+        quantities = stock_service.aggregate(order.items.values_list('product_id', 'qty'))
+        stock_service.release(quantities)
 
         return True
 
+    def aquire_order_product_stock(self, order):
+        """Take stock from product to order item."""
+        quantities = stock_service.aggregate(order.items.values_list('product_id', 'qty'))
+        reservation = stock_service.reserve(quantities)
+
+        return reservation.ok
+
+    def get_status_date_field(self, status):
+        """Get name of the date field tracking a status."""
+        return {
+            Order.OrderStatus.AKTIF.value: 'active_updated',
+            Order.OrderStatus.DIBAYAR.value: 'paid_updated',
+            Order.OrderStatus.DIKIRIM.value: 'sent_updated',
+            Order.OrderStatus.SELESAI.value: 'done_updated',
+            Order.OrderStatus.DIBATALKAN.value: 'canceled_updated',
+        }.get(status)
+
     def update_status_date(self, order, status):
         """Update field status date."""
-        now = timezone.now()
-
-        if status == Order.OrderStatus.AKTIF.value:
-            order.active_updated = now
-        elif status == Order.OrderStatus.DIBAYAR.value:
-            order.paid_updated = now
-        elif status == Order.OrderStatus.DIKIRIM.value:
-            order.sent_updated = now
-        elif status == Order.OrderStatus.SELESAI.value:
-            order.done_updated = now
-        elif status == Order.OrderStatus.DIBATALKAN.value:
-            order.canceled_updated = now
+        date_field = self.get_status_date_field(status)
+
+        if date_field:
+            setattr(order, date_field, timezone.now())
 
         return order
 
     def batch_remove(self, order_ids):
         """Remove multiple orders."""
-        return Order.objects.filter(id__in=order_ids).delete(),
+        with transaction.atomic():
+            orders = list(Order.objects.filter(id__in=order_ids).only('store', 'created', 'done_updated'))
+            deleted = Order.objects.filter(id__in=order_ids).delete()
+            statistic_service.invalidate_orders(orders)
+            self.invalidate_summaries(order_ids)
+
+        return deleted,
 
     def create_order_items(self, order, items):
-        """Create order items."""
-        for item in items:
-            product_id = item['id']
-            order_quantity = item['qty']
-            product = Product.objects.get(pk=product_id)
-            OrderItem.objects.create(
-                order=order,
-                product=product,
-                qty=order_quantity,
-                price=product.selling_price
-            )
-            product.quantity = product.quantity - order_quantity
-            product.save()
+        """Create order items.
+
+        Stock is reserved for all items first, nothing is created when
+        any product is short. Returns the StockReservation.
+        """
+        quantities = stock_service.aggregate((item['id'], item['qty']) for item in items)
+
+        with transaction.atomic():
+            reservation = stock_service.reserve(quantities)
+
+            if not reservation.ok:
+                return reservation
+
+            products = Product.objects.in_bulk(quantities.keys())
+
+            for item in items:
+                product = products[stock_service.product_id(item['id'])]
+                OrderItem.objects.create(
+                    order=order,
+                    product=product,
+                    qty=item['qty'],
+                    price=product.selling_price
+                )
+
+        self.invalidate_items(order)
+        return reservation
 
     def update_order_items(self, order, items):
         """Update order items.
@@ -112,121 +186,98 @@ class OrderService:
         Update order items, by posted order item
         if order item not in posted the remove
         if product posted not in order items then create
+        Stock changes are reserved first, nothing is changed when any
+        product is short. Returns the StockReservation.
+
+        Added, changed and removed items are diffed with dict / set
+        operations and written with one query each, so the query count does
+        not depend on the order size, see
+        BenchmarkService.update_order_items_queries.
         """
-        submited_products_dict = dict([(item['id'], item['qty']) for item in items])  # product id, qty
-        submited_products_ids = submited_products_dict.keys()
-        current_order_items = order.items.all()
-        current_products_ids = []
-
-        # search for current order items
-        for item in current_order_items:
-            product_id = item.product.id
-            current_products_ids.append(product_id)
-
-            if product_id in submited_products_ids:  # old order item
-                order_qty = submited_products_dict[product_id]
-
-                if order_qty != item.qty:  # change DB only if different in quantity
-                    qty_diff = item.qty - order_qty
-                    item.qty = order_qty
-                    item.product.quantity = item.product.quantity + qty_diff  # reduce or increase product stock
-                    item.product.save()
-                    item.save()
-
-            else:
-                # order item to be removed
-                # revert product stock
-                item.product.quantity = item.product.quantity + item.qty
-                item.product.save()
-                item.delete()
-
-        # search for new order items
-        for product_id in submited_products_ids:
-
-            if product_id not in current_products_ids:
-                # add new product to order item
-                order_qty = submited_products_dict[product_id]
-                product = Product.objects.get(pk=product_id)
-                product.quantity = product.quantity - order_qty  # reduce stock
-                product.save()
-
-                OrderItem.objects.create(  # new order item
-                    order=order,
-                    product=product,
-                    price=product.selling_price,
-                    qty=order_qty
-                )
+        submited_products_dict = dict([
+            (stock_service.product_id(item['id']), item['qty']) for item in items
+        ])  # product id, qty
+
+        with transaction.atomic():
+            current_order_items = {item.product_id: item for item in order.items.all()}
+            removed_ids = current_order_items.keys() - submited_products_dict.keys()
+            added_ids = submited_products_dict.keys() - current_order_items.keys()
+            changed_ids = set(
+                product_id for product_id in current_order_items.keys() & submited_products_dict.keys()
+                if current_order_items[product_id].qty != submited_products_dict[product_id]
+            )
+
+            stock_deltas = dict()  # product id, stock to take (negative gives back)
+
+            for product_id in removed_ids:
+                stock_deltas[product_id] = -current_order_items[product_id].qty
+            for product_id in changed_ids:
+                stock_deltas[product_id] = submited_products_dict[product_id] - current_order_items[product_id].qty
+            for product_id in added_ids:
+                stock_deltas[product_id] = submited_products_dict[product_id]
+
+            reservation = stock_service.adjust(stock_deltas)
+
+            if not reservation.ok:
+                return reservation
+
+            if removed_ids:
+                OrderItem.objects.filter(pk__in=[current_order_items[pk].pk for pk in removed_ids]).delete()
+
+            if changed_ids:
+                changed_items = [current_order_items[product_id] for product_id in changed_ids]
+
+                for item in changed_items:
+                    item.qty = submited_products_dict[item.product_id]
+
+                OrderItem.objects.bulk_update(changed_items, ['qty'])
+
+            if added_ids:
+                products = Product.objects.only('id', 'selling_price').in_bulk(added_ids)
+                OrderItem.objects.bulk_create([
+                    OrderItem(
+                        order=order,
+                        product=products[product_id],
+                        price=products[product_id].selling_price,
+                        qty=submited_products_dict[product_id]
+                    )
+                    for product_id in added_ids
+                ])
+
+        self.invalidate_items(order)
+        return reservation
 
     def get_by_store(self, store):
         """Get order store."""
         return Order.objects.filter(store=store)
 
     def get_total_order(self, store, month):
-        """Total Order."""
-        if month is not None:
-            return Order.objects.filter(store=store,
-                                        created__month__gte=month,
-                                        created__month__lte=month).count()
+        """Total Order.
+
+        Orders created in the given month of this year when set, from the
+        daily rollup.
+        """
+        return statistic_service.get_month_totals(store, month)['total_order']
 
-        return Order.objects.filter(store=store).count()
+    async def aget_total_order(self, store, month):
+        """Total Order, async."""
+        return (await statistic_service.aget_month_totals(store, month))['total_order']
 
     def get_total_payment(self, store, month):
-        """Total Payment."""
-        index = 0
-        total_payment = []
-        # Filter_by_Month
-        
-        if month is not None:
-            price = OrderItem.objects.filter(order__status=3,
-                                             order__store=store,
-                                             order__done_updated__month__gte=month,
-                                             order__done_updated__month__lte=month).\
-                                             values('order').\
-                                             annotate(total_payment=Sum(F('qty') * F('product__price'), output_field=FloatField()))
-            selling_price = OrderItem.objects.filter(order__status=3,
-                                                    order__store=store,
-                                                    order__done_updated__month__gte=month,
-                                                    order__done_updated__month__lte=month).\
-                                                    values('order').\
-                                                    annotate(total_payment=Sum(F('qty') * F('price'), output_field=FloatField()))
-            for i in selling_price:
-                total_payment.append(i['total_payment'] - price[index]['total_payment'])
-                index += 1
-                
-            if total_payment is None:
-                total_payment = 0
-            else:
-                total_payment = sum(total_payment)
-                                        
-            return total_payment
-        # Filter_AllTime
-        price = OrderItem.objects.filter(order__store=store,
-                                        order__status=3).values('order').\
-                                        annotate(total_payment=Sum(F('qty') * F('product__price'), output_field=FloatField()))
-        selling_price = OrderItem.objects.filter(order__store=store,
-                                                order__status=3).values('order').\
-                                                annotate(total_payment=Sum(F('qty') * F('price'), output_field=FloatField()))
-
-        for i in selling_price:
-            total_payment.append(i['total_payment'] - price[index]['total_payment'])
-            index += 1
-
-        if total_payment is None:
-            total_payment = 0
-        else:
-            total_payment= sum(total_payment)
-
-        return total_payment
+        """Total Payment.
 
-    def create_order_number(self, store):
-        """Create new order number based on last order number per store perday."""
-        order = Order.objects.filter(store=store, created__date=timezone.now().date()).order_by('-order_number').first()
-        order_number = 1
+        Margin of completed orders, in the given month of this year when set,
+        from the daily rollup.
+        """
+        return statistic_service.get_month_totals(store, month)['total_payment']
 
-        if order and order.order_number > 0:
-            order_number = order.order_number + 1
+    async def aget_total_payment(self, store, month):
+        """Total Payment, async."""
+        return (await statistic_service.aget_month_totals(store, month))['total_payment']
 
-        return order_number
+    def create_order_number(self, store):
+        """Create new order number based on last order number per store perday."""
+        return sequence_service.allocate(store)[0]
 
     def create_invoice_number(self, store, order_number=None, order_type='NB'):
         """Create invoice number per store.
@@ -241,32 +292,72 @@ class OrderService:
         YYMMDD: (example --> 200803)
         Numerical Order: 4 digits, up to 9999
         """
-        uid = store.id.hex[:4]
-        today = timezone.now()
-        dt = dateformat.format(today, 'ymd')
+        today = timezone.localdate()
 
         if not order_number:
-            order_number = self.create_order_number(store)
+            order_number = sequence_service.allocate(store, 1, today)[0]
 
-        if order_number < 1000:
-            order_number = str(10000 + order_number)[-4:]
+        return sequence_service.format_invoice_number(store, order_number, order_type, today)
 
-        return f'{order_type}-{uid}{dt}-{order_number}'
+    def create_invoice_numbers(self, store, count, order_type='NB'):
+        """Create a block of (order number, invoice number) for bulk imports."""
+        today = timezone.localdate()
+
+        return [
+            (order_number, sequence_service.format_invoice_number(store, order_number, order_type, today))
+            for order_number in sequence_service.allocate(store, count, today)
+        ]
 
     def batch_create_cancelation_reason(self, order_ids, option_id, description):
         """Create multiple cancelation reasons."""
-        for order_id in order_ids:
-            OrderCancelReason.objects.create(
+        OrderCancelReason.objects.bulk_create([
+            OrderCancelReason(
                 order_id=order_id,
                 order_cancel_option_id=option_id,
                 description=description
             )
+            for order_id in order_ids
+        ], batch_size=self.BULK_BATCH_SIZE)
+
+    def cancel_orders(self, order_ids, option_id, description):
+        """Cancel orders with their cancelation reason in one transaction.
+
+        Reasons are inserted in bulk, stock of every item is given back with
+        one update per product set and orders are moved with one update.
+        Returns {order id: canceled}, False for orders already canceled or
+        not found.
+        """
+        cancel_status = Order.OrderStatus.DIBATALKAN.value
+        done_status = Order.OrderStatus.SELESAI.value
+
+        with transaction.atomic():
+            orders = Order.objects.select_for_update().filter(id__in=order_ids)\
+                .order_by('id').only('id', 'status', 'store', 'created', 'done_updated')
+            orders = [order for order in orders if order.status != cancel_status]
+            cancel_ids = [order.id for order in orders]
+
+            if cancel_ids:
+                quantities = stock_service.aggregate(
+                    OrderItem.objects.filter(order__in=cancel_ids).values_list('product_id', 'qty'))
+                stock_service.release(quantities)
+                self.batch_create_cancelation_reason(cancel_ids, option_id, description)
+                statistic_service.invalidate_orders(order for order in orders if order.status == done_status)
+                Order.objects.filter(id__in=cancel_ids).update(status=cancel_status, canceled_updated=timezone.now())
+                self.invalidate_summaries(cancel_ids)
+
+        canceled = set(str(order_id) for order_id in cancel_ids)
+        return dict((str(order_id), str(order_id) in canceled) for order_id in order_ids)
 
     def get_by_id(self, order_id):
         """Get by id."""
         order = Order.objects.filter(id=order_id).first()
         return order
 
+    async def aget_by_id(self, order_id):
+        """Get by id, async."""
+        order = await Order.objects.filter(id=order_id).afirst()
+        return order
+
     def get_item_by_order(self, order_id):
         """Get OrderItem by order."""
         item = OrderItem.objects.filter(order=order_id)
@@ -280,15 +371,21 @@ class OrderService:
     def get_total_weight(self, order_id):
         """Get total weight."""
         total_weight = OrderItem.objects.filter(order=order_id).\
-                  aggregate(total_weigth=Sum(F('qty') * F('product__weight'),flat=True, 
+                  aggregate(total_weigth=Sum(F('qty') * F('product__weight'),
                   output_field=PositiveIntegerField())).get('total_weigth')
-        
+
+        return self.format_weight(total_weight)
+
+    def format_weight(self, total_weight):
+        """Format weight in gram, as kg from 1000 gr."""
+        total_weight = total_weight or 0
+
         if total_weight >= 1000:
             total_kg = total_weight / 1000
             return f"{total_kg} kg"
-        
+
         return f"{total_weight} gr"
-    
+
     def get_courier_price(self, order_id):
         """Get courier price."""
         price = Order.objects.filter(id=order_id).values_list('courier_price', flat=True).first()
@@ -296,5 +393,78 @@ class OrderService:
 
         return rupiah
 
+    def get_shipping_summary(self, order_id):
+        """Get shipping summary of an order, None if not found."""
+        return self.get_shipping_summaries([order_id]).get(str(order_id))
+
+    def get_shipping_summaries(self, order_ids):
+        """Get {order id: shipping summary} for shipping labels and invoices.
+
+        Summary holds total_weight, courier_price, dropship_customer and
+        items, the same values as the single getters. Cached per order,
+        the uncached ones cost two queries whatever their number. Saving
+        an order or order item, or deleting an order, drops its summary.
+        Service methods deleting items drop it themselves.
+        """
+        keys = {self.summary_key(order_id): str(order_id) for order_id in order_ids}
+        summaries = {keys[key]: summary for key, summary in cache.get_many(keys.keys()).items()}
+        missing = [order_id for order_id in keys.values() if order_id not in summaries]
+
+        if not missing:
+            return summaries
+
+        orders = Order.objects.filter(id__in=missing).values_list('id', 'courier_price', 'dropship_customer')
+        items = OrderItem.objects.filter(order__in=missing).order_by('id')\
+            .values('order_id', 'product_id', 'qty', 'price', weight=F('product__weight'))
+        order_items = defaultdict(list)
+
+        for item in items:
+            order_items[str(item.pop('order_id'))].append(item)
+
+        computed = dict()
+
+        for order_id, courier_price, dropship_customer in orders:
+            order_id = str(order_id)
+            total_weight = sum(item['qty'] * (item['weight'] or 0) for item in order_items[order_id])
+            computed[order_id] = {
+                'total_weight': self.format_weight(total_weight),
+                'courier_price': common_service.format_rupiah(courier_price or 0),
+                'dropship_customer': dropship_customer,
+                'items': order_items[order_id],
+            }
+
+        cache.set_many({self.summary_key(order_id): summary for order_id, summary in computed.items()},
+                       self.SUMMARY_TIMEOUT)
+        summaries.update(computed)
+
+        return summaries
+
+    def invalidate_summaries(self, order_ids):
+        """Drop cached shipping summaries of orders once the transaction commits."""
+        keys = [self.summary_key(order_id) for order_id in order_ids]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    def invalidate_items(self, order):
+        """Drop cached summary and, for completed orders, statistics of changed order items."""
+        if order.status == Order.OrderStatus.SELESAI.value:
+            statistic_service.invalidate_orders([order])
+
+        self.invalidate_summaries([order.id])
+
+    def invalidate_saved_summary(self, sender, instance, **kwargs):
+        """Drop shipping summary of a saved or deleted order or order item."""
+        self.invalidate_summaries([instance.order_id if sender is OrderItem else instance.pk])
+
+    def summary_key(self, order_id):
+        """Get cache key of an order shipping summary."""
+        return f'order:summary:{order_id}'
+
 
 order_service = OrderService()
+
+for model in (Order, OrderItem):
+    post_save.connect(order_service.invalidate_saved_summary, sender=model,
+                      dispatch_uid=f'order_summary_{model.__name__}')
+
+# no OrderItem delete receiver, it would turn off fast deletes of removed items
+post_delete.connect(order_service.invalidate_saved_summary, sender=Order, dispatch_uid='order_summary_Order')
@@ -0,0 +1,121 @@
+"""Order import service."""
+import json
+from collections import defaultdict
+from itertools import islice
+
+from django.db import transaction
+
+from bolu.models import Order, OrderItem, Product
+from bolu.services.sequence import sequence_service
+from bolu.services.statistic import statistic_service
+from bolu.services.stock import StockReservation, stock_service
+
+
+class OrderImportService:
+    """OrderImportService.
+
+    Creates many orders with their items in chunked transactions. Every
+    chunk locks its products in id order with one query, checks stock in memory and
+    writes orders, items and stock with one bulk query each.
+    """
+
+    CHUNK_SIZE = 500
+
+    def iter_json_lines(self, lines):
+        """Parse JSON lines of {"order": {...}, "items": [{"id", "qty"}]}."""
+        for line in lines:
+            line = line.strip()
+
+            if line:
+                yield json.loads(line)
+
+    def bulk_create_orders(self, orders, chunk_size=CHUNK_SIZE) -> list:
+        """Create orders, returning (order, StockReservation) per input."""
+        return list(self.iter_create_orders(orders, chunk_size))
+
+    def iter_create_orders(self, orders, chunk_size=CHUNK_SIZE):
+        """Create orders from any iterable, one chunk at a time.
+
+        Each input is {'order': Order field values, 'items': [{'id', 'qty'}]}.
+        Yields (order, StockReservation) per input in order, order is None
+        when stock is short. Orders without order_number get one from a
+        block allocated per store.
+        """
+        orders = iter(orders)
+
+        while True:
+            chunk = list(islice(orders, chunk_size))
+
+            if not chunk:
+                break
+
+            yield from self.create_chunk(chunk)
+
+    def create_chunk(self, chunk) -> list:
+        """Create one chunk of orders in a transaction."""
+        to_python = Product._meta.pk.to_python
+        items = [[(to_python(item['id']), item['qty']) for item in data['items']] for data in chunk]
+        quantities = [stock_service.aggregate(order_items) for order_items in items]
+        product_ids = sorted(set(product_id for quantity in quantities for product_id in quantity))
+        results = []
+
+        with transaction.atomic():
+            # same id order as StockService, so imports and checkouts never deadlock
+            products = Product.objects.select_for_update().filter(id__in=product_ids).order_by('id')
+            products = {product.id: product for product in products}
+            accepted = []
+
+            for data, order_items, quantity in zip(chunk, items, quantities):
+                shortages = {
+                    product_id: (qty, products[product_id].quantity if product_id in products else 0)
+                    for product_id, qty in quantity.items()
+                    if product_id not in products or products[product_id].quantity < qty
+                }
+
+                if shortages:
+                    results.append((None, StockReservation(False, shortages)))
+                    continue
+
+                for product_id, qty in quantity.items():
+                    products[product_id].quantity -= qty
+
+                order = Order(**data['order'])
+                accepted.append((order, order_items))
+                results.append((order, StockReservation(True, dict())))
+
+            orders = [order for order, _ in accepted]
+            self.assign_order_numbers(orders)
+            Order.objects.bulk_create(orders)
+            OrderItem.objects.bulk_create([
+                OrderItem(
+                    order=order,
+                    product=products[product_id],
+                    qty=qty,
+                    price=products[product_id].selling_price,
+                )
+                for order, order_items in accepted
+                for product_id, qty in order_items
+            ])
+            touched = sorted(set(product_id for _, order_items in accepted for product_id, _ in order_items))
+            Product.objects.bulk_update([products[product_id] for product_id in touched], ['quantity'])
+            # imported orders may carry past created / done_updated dates
+            statistic_service.invalidate_orders(orders)
+
+        return results
+
+    def assign_order_numbers(self, orders):
+        """Give orders without order_number one from a per store block."""
+        by_store = defaultdict(list)
+
+        for order in orders:
+            if not order.order_number:
+                by_store[order.store_id].append(order)
+
+        for store_orders in by_store.values():
+            numbers = sequence_service.allocate(store_orders[0].store_id, len(store_orders))
+
+            for order, number in zip(store_orders, numbers):
+                order.order_number = number
+
+
+order_import_service = OrderImportService()
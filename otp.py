@@ -1,8 +1,14 @@
 """Otp Service."""
+import datetime
+import hashlib
+import hmac
 import logging
+import time
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import DateTimeField, DurationField, ExpressionWrapper, F
 from django.utils import timezone
 import pyotp
 
@@ -18,26 +24,85 @@ class OTPService:
     FLAG_OLD = 'OLD'
     FLAG_NEW = 'NEW'
 
+    VERIFY_VALID = 'VALID'
+    VERIFY_INVALID = 'INVALID'
+    VERIFY_LIMITED = 'LIMITED'
+    VERIFY_MISS = 'MISS'  # no pending token in cache, check the database
+
+    ATTEMPT_WINDOW = 60 * 5
+    ATTEMPT_LIMIT_NUMBER = 5
+    ATTEMPT_LIMIT_IP = 20
+
     def get_valid_unverified_token(self, user: User, event: OTPToken.Event) -> OTPToken:
-        """Get valid token but not verified."""
-        tokens = OTPToken.objects.filter(
+        """Get valid token but not verified.
+
+        Latest token whose created_at + interval is not passed, in one
+        query served by the (user, event, verified_at, created_at) index.
+        """
+        return self.get_unexpired_tokens(timezone.now()).filter(
             user=user,
             verified_at=None,
             event=event,
-        )
-        now = timezone.now()
-        valid_token = None
+        ).order_by('-created_at').first()
+
+    def get_unexpired_tokens(self, now):
+        """Get tokens not expired at now."""
+        return OTPToken.objects.annotate(expired_at=self.expired_at_expression())\
+            .filter(expired_at__gte=now)
+
+    def expired_at_expression(self):
+        """Get created_at + interval seconds expression."""
+        # typed as a duration, otherwise SQLite adds a number to the datetime
+        interval = ExpressionWrapper(F('interval') * datetime.timedelta(seconds=1), output_field=DurationField())
+
+        return ExpressionWrapper(F('created_at') + interval, output_field=DateTimeField())
+
+    def purge_expired_tokens(self, chunk_size=1000, grace_seconds=0) -> dict:
+        """Delete expired unverified tokens in chunks.
+
+        Verified tokens are kept. Returns rows purged, chunks and seconds.
+        Meant for a scheduled job or management command.
+        """
+        started = time.perf_counter()
+        cutoff = timezone.now() - datetime.timedelta(seconds=grace_seconds)
+        expired = OTPToken.objects.annotate(expired_at=self.expired_at_expression())\
+            .filter(verified_at=None, expired_at__lt=cutoff)
+        purged = chunks = 0
+
+        while True:
+            ids = list(expired.values_list('pk', flat=True)[:chunk_size])
 
-        for token in tokens:
-            delta = now - token.created_at
-            if delta.total_seconds() <= token.interval:
-                valid_token = token
+            if not ids:
                 break
 
-        return valid_token
+            deleted, _ = OTPToken.objects.filter(pk__in=ids).delete()
+            purged += deleted
+            chunks += 1
+
+        metrics = {'purged': purged, 'chunks': chunks, 'seconds': time.perf_counter() - started}
+        logger.info('Purged expired OTP tokens %s', metrics)
+
+        return metrics
 
     def create_new_token(self, user: User, event: OTPToken.Event) -> OTPToken:
         """Create new token."""
+        token = self.build_token(user, event)
+        token.save(force_insert=True)
+        self.cache_pending_token(token, str(user.whatsapp))
+
+        return token
+
+    def create_new_tokens(self, users, event: OTPToken.Event) -> list:
+        """Create new tokens for many users with one insert."""
+        tokens = OTPToken.objects.bulk_create([self.build_token(user, event) for user in users])
+
+        for user, token in zip(users, tokens):
+            self.cache_pending_token(token, str(user.whatsapp))
+
+        return tokens
+
+    def build_token(self, user: User, event: OTPToken.Event) -> OTPToken:
+        """Build unsaved token with a fresh secret and code."""
         now = timezone.now()
         secret = pyotp.random_base32()
         interval = settings.BOLU_OTP_EXPIRE
@@ -47,7 +112,8 @@ class OTPService:
             interval=interval,
         )
         code = totp.at(now)
-        token = OTPToken.objects.create(
+
+        return OTPToken(
             secret=secret,
             code=code,
             interval=interval,
@@ -56,7 +122,95 @@ class OTPService:
             user=user,
         )
 
-        return token
+    def hash_code(self, code: str) -> str:
+        """Get keyed hash of an OTP code."""
+        return hmac.new(settings.SECRET_KEY.encode(), str(code).encode(), hashlib.sha256).hexdigest()
+
+    def pending_key(self, whatsapp: str) -> str:
+        """Get cache key of pending tokens of a whatsapp number."""
+        return f'otp:pending:{whatsapp}'
+
+    def cache_pending_token(self, token: OTPToken, whatsapp: str):
+        """Keep token hash and expiry in cache until it expires."""
+        key = self.pending_key(whatsapp)
+        pending = cache.get(key) or dict()
+        expires_at = token.created_at.timestamp() + token.interval
+        pending[str(token.event)] = {
+            'token_id': token.pk,
+            'user_id': token.user_id,
+            'hash': self.hash_code(token.code),
+            'expires_at': expires_at,
+        }
+        timeout = max(entry['expires_at'] for entry in pending.values()) - time.time()
+        cache.set(key, pending, max(int(timeout) + 1, 1))
+
+    def is_rate_limited(self, scope: str, ident: str, limit: int) -> bool:
+        """Count an attempt and check a sliding window limit.
+
+        The window is approximated from the current and previous fixed
+        window counters, weighted by how much of the previous one overlaps.
+        """
+        now = time.time()
+        window = now // self.ATTEMPT_WINDOW
+        key = f'otp:attempt:{scope}:{ident}:{int(window)}'
+        cache.add(key, 0, self.ATTEMPT_WINDOW * 2)
+
+        try:
+            current = cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, self.ATTEMPT_WINDOW * 2)
+            current = 1
+
+        previous = cache.get(f'otp:attempt:{scope}:{ident}:{int(window) - 1}', 0)
+        overlap = 1 - (now % self.ATTEMPT_WINDOW) / self.ATTEMPT_WINDOW
+
+        return previous * overlap + current > limit
+
+    def verify_cached_token(self, whatsapp: str, token: str, ip: str = None) -> tuple:
+        """Verify token against cached pending tokens of a number.
+
+        Returns (result, user id). Rate limited and wrong guesses are
+        rejected without touching the database, only a valid token writes
+        verified_at. VERIFY_MISS means nothing is cached for the number and
+        the caller should fall back to is_token_valid.
+        """
+        limited = self.is_rate_limited('number', whatsapp, self.ATTEMPT_LIMIT_NUMBER)
+
+        if ip:
+            limited = self.is_rate_limited('ip', ip, self.ATTEMPT_LIMIT_IP) or limited
+
+        if limited:
+            logger.warning('Too many OTP attempts %s %s', whatsapp, ip)
+            return self.VERIFY_LIMITED, None
+
+        key = self.pending_key(whatsapp)
+        pending = cache.get(key)
+
+        if not pending:
+            return self.VERIFY_MISS, None
+
+        code_hash = self.hash_code(token)
+        now = time.time()
+
+        for event, entry in pending.items():
+            if entry['expires_at'] >= now and hmac.compare_digest(entry['hash'], code_hash):
+                verified = OTPToken.objects.filter(pk=entry['token_id'], verified_at=None)\
+                    .update(verified_at=timezone.now())
+                del pending[event]
+
+                if pending:
+                    timeout = max(item['expires_at'] for item in pending.values()) - now
+                    cache.set(key, pending, max(int(timeout) + 1, 1))
+                else:
+                    cache.delete(key)
+
+                if verified:
+                    return self.VERIFY_VALID, entry['user_id']
+
+                break
+
+        logger.warning('Token is not valid %s', token)
+        return self.VERIFY_INVALID, None
 
     def get_registration_token(self, user: User) -> tuple:
         """Get registration token."""
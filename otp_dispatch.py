@@ -0,0 +1,275 @@
+"""OTP dispatch service."""
+import datetime
+import heapq
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from bolu.models import OTPToken
+from bolu.services.otp import otp_service
+from bolu.services.whatsapp import whatsapp_service
+
+logger = logging.getLogger(__name__)
+
+
+class OTPDispatcher:
+    """Send OTP whatsapp messages off the request thread.
+
+    Enqueued messages are drained by a background thread which sends them
+    through a bounded thread pool, retries OFFLINE and UNSET results with
+    exponential backoff and writes sent_at / sent_status back with
+    bulk_update. ``send`` defaults to whatsapp_service.send_message and can
+    be pointed to a fake gateway.
+
+    The queue lives in memory, so every queued token is claimed in the
+    shared cache by this process, which keeps a heartbeat key alive while
+    its drain thread runs. The drain thread also recovers from the
+    database every RECOVER_INTERVAL seconds, starting right away.
+    Unexpired tokens still unsent RECOVER_AFTER seconds after creation
+    whose claim is missing or held by a process without heartbeat were
+    lost by a recycled or crashed process and are queued again, one
+    process taking each over. Call start() from AppConfig.ready to
+    recover without waiting for the first enqueue.
+    """
+
+    RETRY_STATUSES = (OTPToken.SentStatus.OFFLINE, OTPToken.SentStatus.UNSET)
+    RECOVER_AFTER = 60
+    RECOVER_INTERVAL = 60
+    HEARTBEAT_TIMEOUT = 60 * 5
+    CLAIM_TIMEOUT = 60 * 60
+    TEMPLATES = {
+        OTPToken.Event.LOGIN: 'BOLU_OTP_LOGIN_TEMPLATE',
+        OTPToken.Event.REGISTRATION: 'BOLU_OTP_REGISTRATION_TEMPLATE',
+    }
+
+    def __init__(self, send=None, workers=4, max_attempts=3, backoff=2.0, batch_size=50):
+        self.send = send or whatsapp_service.send_message
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._retries = []  # heap of (due, sequence, message)
+        self._sequence = 0
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._recover_at = 0
+        self._instance = (None, None)  # pid, instance id
+
+    def enqueue(self, token: OTPToken, to: str, message: str):
+        """Queue a message for token and return immediately.
+
+        Inside a transaction the message is queued once it commits, so the
+        drain thread always sees the token row.
+        """
+        self.enqueue_many([(token, to, message)])
+
+    def enqueue_many(self, messages):
+        """Queue (token, to, message) tuples at once and return immediately."""
+        messages = [
+            {'token_id': token.pk, 'to': to, 'message': message, 'attempt': 1}
+            for token, to, message in messages
+        ]
+
+        if messages:
+            transaction.on_commit(lambda: self.put(messages))
+
+    def put(self, messages):
+        """Claim and put message dicts on the queue, making sure the drain thread runs."""
+        instance_id = self.instance_id()
+        self.heartbeat()
+        cache.set_many({self.claim_key(message['token_id']): instance_id for message in messages},
+                       self.CLAIM_TIMEOUT)
+
+        with self._idle:
+            self._pending += len(messages)
+
+        for message in messages:
+            self._queue.put(message)
+
+        self.start()
+
+    def start(self):
+        """Start drain thread once per process."""
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+
+        with self._idle:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._recover_at = 0
+            self._thread = threading.Thread(target=self._drain, name='otp-dispatch', daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout=None) -> bool:
+        """Block until every queued message got its final status."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def recover(self):
+        """Queue unexpired tokens left unsent by processes which are gone.
+
+        Tokens claimed by a process with a heartbeat are still in flight
+        and skipped.
+        """
+        now = timezone.now()
+        tokens = list(otp_service.get_unexpired_tokens(now).filter(
+            sent_at=None,
+            verified_at=None,
+            created_at__lt=now - datetime.timedelta(seconds=self.RECOVER_AFTER),
+            event__in=self.TEMPLATES.keys(),
+        ).select_related('user'))
+
+        if not tokens:
+            return
+
+        claims = cache.get_many([self.claim_key(token.pk) for token in tokens])
+        alive = cache.get_many([self.heartbeat_key(owner) for owner in set(claims.values())])
+        messages = []
+
+        for token in tokens:
+            owner = claims.get(self.claim_key(token.pk))
+
+            if owner and self.heartbeat_key(owner) in alive:
+                continue
+
+            # only one process takes a token over from the same owner
+            if not cache.add(f'{self.claim_key(token.pk)}:{owner}', True, self.RECOVER_AFTER):
+                continue
+
+            messages.append({
+                'token_id': token.pk,
+                'to': str(token.user.whatsapp),
+                'message': getattr(settings, self.TEMPLATES[token.event]).format(code=token.code),
+                'attempt': 1,
+            })
+
+        if messages:
+            logger.info('Recovered %s unsent OTP whatsapp messages', len(messages))
+            self.put(messages)
+
+    def instance_id(self):
+        """Get id of this process dispatcher, new after a fork."""
+        pid = os.getpid()
+
+        if self._instance[0] != pid:
+            self._instance = (pid, uuid.uuid4().hex)
+
+        return self._instance[1]
+
+    def heartbeat(self):
+        """Mark this process dispatcher alive for HEARTBEAT_TIMEOUT seconds."""
+        cache.set(self.heartbeat_key(self.instance_id()), True, self.HEARTBEAT_TIMEOUT)
+
+    def heartbeat_key(self, instance_id):
+        """Get cache key of a dispatcher heartbeat."""
+        return f'otp_dispatch:alive:{instance_id}'
+
+    def claim_key(self, token_id):
+        """Get cache key of the dispatcher holding a token."""
+        return f'otp_dispatch:claim:{token_id}'
+
+    def _drain(self):
+        """Send queued and due retry messages in batches, recovering lost ones."""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='otp-send') as pool:
+            while True:
+                try:
+                    self.heartbeat()
+                except Exception:
+                    logger.exception('Failed storing OTP dispatcher heartbeat')
+
+                if time.monotonic() >= self._recover_at:
+                    self._recover_at = time.monotonic() + self.RECOVER_INTERVAL
+
+                    try:
+                        self.recover()
+                    except Exception:
+                        logger.exception('Failed recovering unsent OTP whatsapp messages')
+                    finally:
+                        close_old_connections()
+
+                batch = self._next_batch()
+
+                if not batch:
+                    continue
+
+                results = list(pool.map(self._send, batch))
+                self._record(batch, results)
+
+    def _next_batch(self) -> list:
+        """Get up to batch_size messages, waiting for the first one."""
+        batch = []
+        now = time.monotonic()
+
+        while self._retries and self._retries[0][0] <= now and len(batch) < self.batch_size:
+            batch.append(heapq.heappop(self._retries)[2])
+
+        timeout = max(self._recover_at - now, 0)
+
+        if self._retries:
+            timeout = min(timeout, max(self._retries[0][0] - now, 0))
+
+        try:
+            if not batch:
+                batch.append(self._queue.get(timeout=timeout))
+
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        return batch
+
+    def _send(self, message):
+        """Send one message, returning parsed status."""
+        try:
+            response = self.send(message['to'], message['message'])
+        except Exception:
+            logger.exception('Failed sending OTP whatsapp to %s', message['to'])
+            response = None
+
+        return otp_service.get_wa_send_message_status(response)
+
+    def _record(self, batch, results):
+        """Store statuses and schedule retries."""
+        now = timezone.now()
+        tokens = []
+        done = 0
+
+        for message, status in zip(batch, results):
+            tokens.append(OTPToken(pk=message['token_id'], sent_at=now, sent_status=status))
+
+            if status in self.RETRY_STATUSES and message['attempt'] < self.max_attempts:
+                delay = self.backoff ** message['attempt']
+                message['attempt'] += 1
+                self._sequence += 1
+                heapq.heappush(self._retries, (time.monotonic() + delay, self._sequence, message))
+            else:
+                done += 1
+
+        try:
+            OTPToken.objects.bulk_update(tokens, ['sent_at', 'sent_status'])
+        except Exception:
+            logger.exception('Failed updating OTP sent status')
+        finally:
+            close_old_connections()
+
+        with self._idle:
+            self._pending -= done
+            self._idle.notify_all()
+
+
+otp_dispatcher = OTPDispatcher()
@@ -1,7 +1,6 @@
 """Product service."""
-from django.db.models import Sum
-
-from bolu.models import Order, Product
+from bolu.models import Product
+from bolu.services.statistic import statistic_service
 
 
 class ProductService:
@@ -10,15 +9,19 @@ class ProductService:
         """Total Product."""
         return Product.objects.filter(store=store, is_deleted=False).count()
 
+    async def aget_total_product(self, store):
+        """Total Product, async."""
+        return await Product.objects.filter(store=store, is_deleted=False).acount()
+
     def get_total_product_sold(self, store, month):
-        """Total Product."""
-        if month is not None:
-            return Order.objects.filter(store=store,
-                                        status=3,
-                                        done_updated__month__gte=month,
-                                        done_updated__month__lte=month).aggregate(Sum('items__qty')).get('items__qty__sum')
+        """Total Product.
 
-        return Order.objects.filter(store=store, status=3).aggregate(Sum('items__qty')).get('items__qty__sum')
+        Sold in the given month of this year when set, from the daily rollup.
+        """
+        return statistic_service.get_month_totals(store, month)['total_product_sold']
 
+    async def aget_total_product_sold(self, store, month):
+        """Total Product sold, async."""
+        return (await statistic_service.aget_month_totals(store, month))['total_product_sold']
 
 product_service = ProductService()
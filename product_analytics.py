@@ -0,0 +1,108 @@
+"""Product analytics service."""
+import datetime
+
+from django.core.cache import cache
+from django.db.models import F, FloatField, Sum
+from django.utils import timezone
+
+from bolu.models import Order, OrderItem, Product
+from bolu.services.statistic import statistic_service
+
+
+class ProductAnalyticsService:
+    """ProductAnalyticsService.
+
+    Per store product leaderboard and stock velocity, computed with two
+    queries and kept in the shared cache. refresh_stores is meant to run
+    on a schedule, the seller app product list then reads per product
+    numbers from get without any query.
+    """
+
+    WINDOW_DAYS = 30
+    TOP = 10
+    LOW_STOCK_DAYS = 7
+    CACHE_TIMEOUT = 60 * 60 * 24
+
+    def compute(self, store, window_days=WINDOW_DAYS, top=TOP, low_stock_days=LOW_STOCK_DAYS) -> dict:
+        """Compute product analytics of a store.
+
+        Sales are completed order items of the last window_days days.
+        Days of stock left is quantity over average units sold per day.
+        """
+        now = timezone.now()
+        since = now - datetime.timedelta(days=window_days)
+        sales = OrderItem.objects.filter(order__store=store,
+                                         order__status=Order.OrderStatus.SELESAI.value,
+                                         order__done_updated__gte=since)\
+            .values('product_id')\
+            .annotate(
+                units=Sum('qty'),
+                revenue=Sum(F('qty') * F('price'), output_field=FloatField()),
+                margin=statistic_service.payment_expression(),
+            ).order_by()
+        sales = {row.pop('product_id'): row for row in sales}
+        stocks = Product.objects.filter(store=store, is_deleted=False).values_list('id', 'quantity')
+        products = dict()
+
+        for product_id, quantity in stocks:
+            row = sales.get(product_id, {})
+            units = row.get('units') or 0
+            velocity = units / window_days
+            products[product_id] = {
+                'units': units,
+                'revenue': row.get('revenue') or 0,
+                'margin': row.get('margin') or 0,
+                'quantity': quantity,
+                'velocity': velocity,
+                'days_of_stock': quantity / velocity if velocity else None,
+            }
+
+        def top_by(metric):
+            ranked = sorted((product_id for product_id in products if products[product_id][metric] > 0),
+                            key=lambda product_id: products[product_id][metric], reverse=True)
+            return ranked[:top]
+
+        low_stock = [
+            product_id for product_id, stats in products.items()
+            if stats['quantity'] <= 0
+            or (stats['days_of_stock'] is not None and stats['days_of_stock'] <= low_stock_days)
+        ]
+        low_stock.sort(key=lambda product_id: products[product_id]['days_of_stock'] or 0)
+
+        return {
+            'computed_at': now,
+            'window_days': window_days,
+            'products': products,
+            'top_units': top_by('units'),
+            'top_revenue': top_by('revenue'),
+            'top_margin': top_by('margin'),
+            'low_stock': low_stock,
+        }
+
+    def refresh(self, store) -> dict:
+        """Compute and cache product analytics of a store."""
+        analytics = self.compute(store)
+        cache.set(self.cache_key(store.id), analytics, self.CACHE_TIMEOUT)
+
+        return analytics
+
+    def refresh_stores(self, stores):
+        """Refresh product analytics of many stores, for scheduled jobs."""
+        for store in stores:
+            self.refresh(store)
+
+    def get(self, store) -> dict:
+        """Get cached product analytics, computing them when missing."""
+        return cache.get(self.cache_key(store.id)) or self.refresh(store)
+
+    def get_product_stats(self, store, product_ids) -> dict:
+        """Get {product id: stats} for a product list page."""
+        products = self.get(store)['products']
+        return {product_id: products.get(product_id) for product_id in product_ids}
+
+    def cache_key(self, store_id):
+        """Get cache key of a store product analytics."""
+        return f'product_analytics:{store_id}'
+
+
+product_analytics_service = ProductAnalyticsService()
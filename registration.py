@@ -4,11 +4,14 @@ import uuid
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.utils import timezone
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from bolu.models import OTPToken
 
 from .otp import otp_service
+from .otp_dispatch import otp_dispatcher
 from .user import user_service
-from .whatsapp import whatsapp_service
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
@@ -20,7 +23,8 @@ class RegistrationService:
     def send_wa_activation(self, user_id: uuid.UUID):
         """Send verification url to whatsapp.
 
-        This function should be run async as it takes a while to send whatsapp
+        The message is queued to otp_dispatcher, sent_at and sent_status
+        are stored once it is sent.
         """
         user = User.objects.get(pk=user_id)
         token, flag = otp_service.get_registration_token(user)
@@ -28,11 +32,7 @@ class RegistrationService:
         if flag == otp_service.FLAG_NEW:
             message = settings.BOLU_OTP_REGISTRATION_TEMPLATE.format(code=token.code)
             to = str(user.whatsapp)
-            response = whatsapp_service.send_message(to, message)
-            token.sent_at = timezone.now()
-            token_status = otp_service.get_wa_send_message_status(response)
-            token.sent_status = token_status
-            token.save()
+            otp_dispatcher.enqueue(token, to, message)
         else:
             pass  # do we need to send whatsapp while old token still valid?
 
@@ -54,22 +54,81 @@ class RegistrationService:
         user = user_service.get_by_whatsapp(data['whatsapp'])
 
         if not user:
-            full_name = data['full_name']
-            first_name, last_name = self.full_name_split(full_name)
-            del data['full_name']
-            del data['store_name']
-            user = User(**data)
-            user.first_name = first_name
-            user.last_name = last_name
-            user.username = data['email']
-            user.is_active = False
-            user.set_password(settings.BOLU_STANDARD_PASSWORD)
+            user = self.build_user(data)
             user.save()
 
         return user
 
-    def confirm_token(self, whatsapp: str, token: str) -> object:
-        """Confirm token on registration."""
+    def register_many(self, data_list) -> list:
+        """Register many users and queue their activation whatsapp.
+
+        Known and repeated whatsapp numbers are skipped with one query,
+        new users are created with one insert and their OTP tokens with
+        another. Returns created users.
+        """
+        data_list = list(data_list)
+        whatsapps = [str(data['whatsapp']) for data in data_list]
+        existing = set(
+            str(whatsapp) for whatsapp in
+            User.objects.filter(whatsapp__in=whatsapps).values_list('whatsapp', flat=True)
+        )
+        users = []
+
+        for data, whatsapp in zip(data_list, whatsapps):
+            if whatsapp not in existing:
+                existing.add(whatsapp)
+                users.append(self.build_user(dict(data)))
+
+        with transaction.atomic():
+            users = User.objects.bulk_create(users)
+            tokens = otp_service.create_new_tokens(users, OTPToken.Event.REGISTRATION)
+            otp_dispatcher.enqueue_many(
+                (token, str(user.whatsapp), settings.BOLU_OTP_REGISTRATION_TEMPLATE.format(code=token.code))
+                for user, token in zip(users, tokens)
+            )
+
+        return users
+
+    def build_user(self, data) -> User:
+        """Build unsaved inactive user with the standard password."""
+        full_name = data['full_name']
+        first_name, last_name = self.full_name_split(full_name)
+        del data['full_name']
+        del data['store_name']
+        user = User(**data)
+        user.first_name = first_name
+        user.last_name = last_name
+        user.username = data['email']
+        user.is_active = False
+        user.password = self.get_standard_password_hash()
+
+        return user
+
+    def get_standard_password_hash(self) -> str:
+        """Hash standard password once per process."""
+        password = settings.BOLU_STANDARD_PASSWORD
+
+        if getattr(self, '_standard_password', None) != password:
+            self._standard_password_hash = make_password(password)
+            self._standard_password = password
+
+        return self._standard_password_hash
+
+    def confirm_token(self, whatsapp: str, token: str, ip: str = None) -> object:
+        """Confirm token on registration.
+
+        Checked against the cached pending token first, the database is
+        only read when nothing is cached for the number.
+        """
+        result, user_id = otp_service.verify_cached_token(whatsapp, token, ip)
+
+        if result == otp_service.VERIFY_VALID:
+            User.objects.filter(pk=user_id).update(is_active=True)
+            return True
+        elif result != otp_service.VERIFY_MISS:
+            logger.warn('Invalid token %s %s', whatsapp, token)
+            return False
+
         user = user_service.get_by_whatsapp(whatsapp)
 
         if user:
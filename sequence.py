@@ -0,0 +1,76 @@
+"""Sequence service."""
+import datetime
+
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import dateformat, timezone
+
+from bolu.models import Order, OrderSequence
+
+
+class SequenceService:
+    """SequenceService.
+
+    Hands out per store per day order numbers from an OrderSequence
+    (store, date) counter row. The row is created once a day, seeded from
+    the highest order number in the database, after that every allocation
+    locks the row and bumps last_number with an F() update. Numbers are
+    never handed out twice, across processes and cache flushes alike.
+
+    Called inside a transaction the row stays locked until it commits, so
+    allocate right before inserting the orders. Needs the OrderSequence
+    model and its migration in bolu.models.
+    """
+
+    def allocate(self, store, count=1, date=None) -> range:
+        """Reserve a block of ``count`` order numbers for store on date.
+
+        store may be a Store or its id.
+        """
+        date = date or timezone.localdate()
+        store_id = getattr(store, 'pk', store)
+
+        with transaction.atomic():
+            sequence = self.get_sequence(store_id, date)
+            OrderSequence.objects.filter(pk=sequence.pk).update(last_number=F('last_number') + count)
+
+        return range(sequence.last_number + 1, sequence.last_number + count + 1)
+
+    def get_sequence(self, store_id, date) -> OrderSequence:
+        """Get locked counter row of store on date, creating it when missing."""
+        sequence = OrderSequence.objects.select_for_update().filter(store_id=store_id, date=date).first()
+
+        if sequence is None:
+            sequence, _ = OrderSequence.objects.select_for_update().get_or_create(
+                store_id=store_id,
+                date=date,
+                defaults={'last_number': self.get_last_order_number(store_id, date)},
+            )
+
+        return sequence
+
+    def get_last_order_number(self, store_id, date) -> int:
+        """Get highest order number of store on date from the database."""
+        start = timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+        end = start + datetime.timedelta(days=1)
+        order_number = Order.objects.filter(store_id=store_id, created__gte=start, created__lt=end)\
+            .aggregate(last=Max('order_number')).get('last')
+
+        return max(order_number or 0, 0)
+
+    def format_invoice_number(self, store, order_number, order_type='NB', date=None) -> str:
+        """Format invoice number, TT-UIDYYMMDD-NNNN.
+
+        date is the local date the order number was allocated on, today
+        by default.
+        """
+        uid = store.id.hex[:4]
+        dt = dateformat.format(date or timezone.localdate(), 'ymd')
+
+        if order_number < 1000:
+            order_number = str(10000 + order_number)[-4:]
+
+        return f'{order_type}-{uid}{dt}-{order_number}'
+
+
+sequence_service = SequenceService()
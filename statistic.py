@@ -0,0 +1,323 @@
+"""Statistic service."""
+import datetime
+from collections import defaultdict
+from typing import NamedTuple
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Min, Q, Sum
+from django.db.models import DateField
+from django.db.models.functions import TruncDate, TruncDay, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from bolu.models import Order, OrderItem, Product
+
+
+class Margin(NamedTuple):
+    """Margin of completed orders.
+
+    Breakdowns are None unless requested, otherwise {key: margin} keyed by
+    order id, done date or product id.
+    """
+
+    total: float
+    by_order: dict = None
+    by_day: dict = None
+    by_product: dict = None
+
+
+class StatisticService:
+    """StatisticService.
+
+    Store dashboard metrics backed by a per store daily rollup kept in the
+    shared cache. Closed days never change unless an order leaves or
+    enters SELESAI, which invalidates the affected day, so a dashboard read
+    only recomputes today and the missing days.
+    """
+
+    ROLLUP_TIMEOUT = 60 * 60 * 24 * 31
+    SERIES_TIMEOUT = 60 * 60 * 24 * 31
+    TRUNCS = {'day': TruncDay, 'week': TruncWeek, 'month': TruncMonth}
+    EMPTY_DAY = {'total_order': 0, 'total_product_sold': 0, 'total_payment': 0}
+
+    def month_range(self, month, year=None) -> tuple:
+        """Get [start, end) dates of a month, current year by default."""
+        year = year or timezone.localdate().year
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + month // 12, month % 12 + 1, 1)
+
+        return start, end
+
+    def to_datetime(self, date):
+        """Get aware datetime at start of date."""
+        return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+    def payment_expression(self, prefix='', filter=None):
+        """Get margin expression, sold price minus product base price."""
+        return Sum(
+            F(f'{prefix}qty') * (F(f'{prefix}price') - F(f'{prefix}product__price')),
+            filter=filter,
+            output_field=FloatField(),
+        )
+
+    def get_margin(self, store, start=None, end=None, breakdown=()) -> Margin:
+        """Get margin of store orders completed in [start, end) dates.
+
+        breakdown may hold 'order', 'day' and 'product'. Each breakdown is
+        one query grouped by its own key only, the total comes from the
+        first breakdown or from one aggregate without any.
+        """
+        items = self.margin_queryset(store, start, end)
+
+        if not breakdown:
+            total = items.aggregate(margin=self.payment_expression()).get('margin')
+            return Margin(total or 0)
+
+        groups = {
+            'order': {'key': F('order_id')},
+            'day': {'key': TruncDate('order__done_updated')},
+            'product': {'key': F('product_id')},
+        }
+        breakdowns = dict()
+
+        for name in breakdown:
+            rows = items.values(**groups[name]).annotate(margin=self.payment_expression()).order_by()
+            breakdowns[f'by_{name}'] = {row['key']: row['margin'] or 0 for row in rows}
+
+        return Margin(sum(next(iter(breakdowns.values())).values()), **breakdowns)
+
+    async def aget_margin_total(self, store, start=None, end=None):
+        """Get margin total of store orders completed in [start, end), async."""
+        total = await self.margin_queryset(store, start, end)\
+            .aaggregate(margin=self.payment_expression())
+        return total.get('margin') or 0
+
+    def margin_queryset(self, store, start=None, end=None):
+        """Get items of store orders completed in [start, end) dates."""
+        items = OrderItem.objects.filter(order__store=store, order__status=Order.OrderStatus.SELESAI.value)
+
+        if start:
+            items = items.filter(order__done_updated__gte=self.to_datetime(start))
+        if end:
+            items = items.filter(order__done_updated__lt=self.to_datetime(end))
+
+        return items
+
+    def get_dashboard(self, store, start=None, end=None) -> dict:
+        """Get dashboard metrics of a store in [start, end) from the daily rollup."""
+        statistics = self.get_totals(store, start, end)
+        statistics['total_product'] = Product.objects.filter(store=store, is_deleted=False).count()
+
+        return statistics
+
+    async def aget_dashboard(self, store, start=None, end=None) -> dict:
+        """Get dashboard metrics of a store in [start, end), async."""
+        return await sync_to_async(self.get_dashboard)(store, start, end)
+
+    def get_totals(self, store, start=None, end=None) -> dict:
+        """Get total_order, total_product_sold and total_payment in [start, end).
+
+        Summed from the daily rollup, so a read costs O(days) not O(orders).
+        Without start the range begins on the store first order day, days
+        after today are never read.
+        """
+        tomorrow = timezone.localdate() + datetime.timedelta(days=1)
+        end = min(end, tomorrow) if end else tomorrow
+
+        if start is None:
+            first = Order.objects.filter(store=store).aggregate(first=Min('created')).get('first')
+            start = timezone.localdate(first) if first else end
+
+        totals = dict(self.EMPTY_DAY)
+
+        if start < end:
+            for day in self.get_daily_statistics(store, start, end).values():
+                for key, value in day.items():
+                    totals[key] += value
+
+        return totals
+
+    def get_month_totals(self, store, month=None) -> dict:
+        """Get totals of the given month of this year, all time without month."""
+        if month is not None:
+            return self.get_totals(store, *self.month_range(month))
+
+        return self.get_totals(store)
+
+    async def aget_month_totals(self, store, month=None) -> dict:
+        """Get totals of the given month of this year, async."""
+        return await sync_to_async(self.get_month_totals)(store, month)
+
+    def get_daily_statistics(self, store, start, end) -> dict:
+        """Get {date: metrics} of a store for every day in [start, end).
+
+        Cached days are read in one cache call, the missing ones are
+        computed with one grouped query per metric date field.
+        """
+        days = [start + datetime.timedelta(days=i) for i in range((end - start).days)]
+        keys = {self.rollup_key(store.id, day): day for day in days}
+        cached = cache.get_many(keys.keys())
+        rollup = {keys[key]: value for key, value in cached.items()}
+        missing = [day for day in days if day not in rollup]
+
+        if not missing:
+            return rollup
+
+        computed = {day: dict(self.EMPTY_DAY) for day in missing}
+        missing_start = self.to_datetime(min(missing))
+        missing_end = self.to_datetime(max(missing) + datetime.timedelta(days=1))
+
+        orders = Order.objects.filter(store=store, created__gte=missing_start, created__lt=missing_end)\
+            .annotate(day=TruncDate('created')).values('day').annotate(total_order=Count('id'))
+
+        for row in orders:
+            if row['day'] in computed:
+                computed[row['day']]['total_order'] = row['total_order']
+
+        sold = Order.objects.filter(store=store,
+                                    status=Order.OrderStatus.SELESAI.value,
+                                    done_updated__gte=missing_start,
+                                    done_updated__lt=missing_end,
+                                    items__isnull=False)\
+            .annotate(day=TruncDate('done_updated')).values('day')\
+            .annotate(total_product_sold=Sum('items__qty'), total_payment=self.payment_expression('items__'))
+
+        for row in sold:
+            if row['day'] in computed:
+                computed[row['day']]['total_product_sold'] = row['total_product_sold'] or 0
+                computed[row['day']]['total_payment'] = row['total_payment'] or 0
+
+        today = timezone.localdate()
+        cache.set_many({
+            self.rollup_key(store.id, day): value for day, value in computed.items() if day < today
+        }, self.ROLLUP_TIMEOUT)
+        rollup.update(computed)
+
+        return rollup
+
+    def bucket_start(self, date, period):
+        """Get start date of the period bucket holding date."""
+        if period == 'week':
+            return date - datetime.timedelta(days=date.weekday())
+        if period == 'month':
+            return date.replace(day=1)
+
+        return date
+
+    def next_bucket(self, date, period):
+        """Get start date of the bucket after the one starting at date."""
+        if period == 'week':
+            return date + datetime.timedelta(days=7)
+        if period == 'month':
+            return datetime.date(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+        return date + datetime.timedelta(days=1)
+
+    def get_time_series(self, store, start, end, period='month') -> list:
+        """Get orders, units sold, revenue and margin per day, week or month.
+
+        Buckets cover [start, end) widened to whole periods. Orders count by
+        created, the rest by done_updated of completed orders, all from one
+        grouped query on date ranges. Closed buckets are cached as they
+        never change; the query only covers buckets not cached yet.
+        """
+        buckets = []
+        bucket = self.bucket_start(start, period)
+
+        while bucket < end:
+            buckets.append(bucket)
+            bucket = self.next_bucket(bucket, period)
+
+        if not buckets:
+            return []
+
+        keys = {self.series_key(store.id, period, bucket): bucket for bucket in buckets}
+        series = {keys[key]: value for key, value in cache.get_many(keys.keys()).items()}
+        missing = [bucket for bucket in buckets if bucket not in series]
+
+        if missing:
+            computed = self.compute_time_series(store, missing[0], self.next_bucket(missing[-1], period), period)
+            closed_before = self.bucket_start(timezone.localdate(), period)
+            cache.set_many({
+                self.series_key(store.id, period, bucket): computed[bucket]
+                for bucket in missing if bucket < closed_before
+            }, self.SERIES_TIMEOUT)
+            series.update((bucket, computed[bucket]) for bucket in missing)
+
+        return [dict(period_start=bucket, **series[bucket]) for bucket in buckets]
+
+    def compute_time_series(self, store, start, end, period) -> dict:
+        """Compute {bucket: metrics} for buckets in [start, end) with one query."""
+        trunc = self.TRUNCS[period]
+        start, end = self.to_datetime(start), self.to_datetime(end)
+        done_status = Order.OrderStatus.SELESAI.value
+        created = Q(created__gte=start, created__lt=end)
+        done = Q(status=done_status, done_updated__gte=start, done_updated__lt=end)
+        rows = Order.objects.filter(created | done, store=store)\
+            .values(
+                created_bucket=trunc('created', output_field=DateField()),
+                done_bucket=trunc('done_updated', output_field=DateField()),
+            )\
+            .annotate(
+                total_order=Count('id', filter=created, distinct=True),
+                total_product_sold=Sum('items__qty', filter=done),
+                total_revenue=Sum(F('items__qty') * F('items__price'), filter=done, output_field=FloatField()),
+                total_payment=self.payment_expression('items__', filter=done),
+            ).order_by()
+        metrics = defaultdict(lambda: dict(self.EMPTY_DAY, total_revenue=0))
+
+        for row in rows:
+            if row['total_order']:
+                metrics[row['created_bucket']]['total_order'] += row['total_order']
+
+            if row['total_product_sold'] is not None:
+                bucket = metrics[row['done_bucket']]
+                bucket['total_product_sold'] += row['total_product_sold']
+                bucket['total_revenue'] += row['total_revenue'] or 0
+                bucket['total_payment'] += row['total_payment'] or 0
+
+        result = dict()
+        bucket = start.date()
+
+        while bucket < end.date():
+            result[bucket] = metrics[bucket]
+            bucket = self.next_bucket(bucket, period)
+
+        return result
+
+    def series_key(self, store_id, period, bucket):
+        """Get cache key of a store time series bucket."""
+        return f'statistic:{period}:{store_id}:{bucket.isoformat()}'
+
+    def invalidate_orders(self, orders):
+        """Drop rollup days and time series buckets touched by orders.
+
+        Call with orders before their status or done date changes. Keys
+        are dropped once the current transaction commits, so a concurrent
+        read can not cache the old rows again.
+        """
+        keys = set()
+        today = timezone.localdate()
+
+        for order in orders:
+            for date in (order.created, order.done_updated):
+                if date:
+                    date = timezone.localdate(date)
+                    keys.add(self.rollup_key(order.store_id, date))
+                    keys.update(
+                        self.series_key(order.store_id, period, self.bucket_start(date, period))
+                        for period in self.TRUNCS
+                    )
+
+            keys.add(self.rollup_key(order.store_id, today))
+
+        if keys:
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
+    def rollup_key(self, store_id, day):
+        """Get cache key of a store daily rollup."""
+        return f'statistic:daily:{store_id}:{day.isoformat()}'
+
+
+statistic_service = StatisticService()
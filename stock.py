@@ -0,0 +1,121 @@
+"""Stock service."""
+from collections import defaultdict
+from typing import NamedTuple
+
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+
+from bolu.models import Product
+
+
+class StockReservation(NamedTuple):
+    """Result of a stock reservation.
+
+    shortages maps product id to (requested, available) for every product
+    which did not have enough stock.
+    """
+
+    ok: bool
+    shortages: dict
+
+
+class StockService:
+    """StockService.
+
+    Product quantity is only changed with a conditional F() update on rows
+    locked in ascending id order, so concurrent checkouts never oversell
+    and never deadlock each other.
+    """
+
+    def aggregate(self, items):
+        """Sum (product id, qty) pairs per product.
+
+        Product ids may be pk values or their strings, e.g. from a request.
+        """
+        quantities = defaultdict(int)
+
+        for product_id, qty in items:
+            quantities[self.product_id(product_id)] += qty
+
+        return dict(quantities)
+
+    def product_id(self, value):
+        """Get product pk value of a pk or its string."""
+        return Product._meta.pk.to_python(value)
+
+    def reserve(self, quantities) -> StockReservation:
+        """Take stock for {product id: qty}, all or nothing."""
+        return self.adjust(quantities)
+
+    def release(self, quantities):
+        """Give stock back for {product id: qty}."""
+        with transaction.atomic():
+            self.lock(quantities.keys())
+            self.apply({product_id: -qty for product_id, qty in quantities.items()})
+
+    def lock(self, product_ids) -> dict:
+        """Lock products in id order, returns {product id: quantity}."""
+        products = Product.objects.select_for_update()\
+            .filter(id__in=product_ids).order_by('id').values_list('id', 'quantity')
+        return dict(products)
+
+    def adjust(self, deltas) -> StockReservation:
+        """Apply stock changes for {product id: qty}, all or nothing.
+
+        Positive qty takes stock, negative qty gives it back. Two queries
+        whatever the number of products.
+        """
+        deltas = {product_id: qty for product_id, qty in self.aggregate(deltas.items()).items() if qty}
+        shortages = dict()
+
+        if not deltas:
+            return StockReservation(True, shortages)
+
+        with transaction.atomic():
+            available = self.lock(deltas.keys())
+
+            for product_id in sorted(deltas):
+                qty = deltas[product_id]
+                stock = available.get(product_id, 0)
+
+                if qty > 0 and stock < qty:
+                    shortages[product_id] = (qty, stock)
+
+            if shortages:
+                return StockReservation(False, shortages)
+
+            if not self.apply(deltas):
+                transaction.set_rollback(True)
+                shortages = {
+                    product_id: (qty, available.get(product_id, 0))
+                    for product_id, qty in deltas.items() if qty > 0
+                }
+                return StockReservation(False, shortages)
+
+        return StockReservation(True, shortages)
+
+    def apply(self, deltas) -> bool:
+        """Change stock of every product in one conditional update.
+
+        Products taking stock must have quantity >= qty, returns False when
+        any row did not match.
+        """
+        deltas = {product_id: qty for product_id, qty in deltas.items() if qty}
+
+        if not deltas:
+            return True
+
+        condition = Q()
+
+        for product_id, qty in deltas.items():
+            condition |= Q(id=product_id, quantity__gte=qty) if qty > 0 else Q(id=product_id)
+
+        updated = Product.objects.filter(condition).update(quantity=Case(
+            *[When(id=product_id, then=F('quantity') - qty) for product_id, qty in deltas.items()],
+            default=F('quantity'),
+        ))
+
+        return updated == len(deltas)
+
+
+stock_service = StockService()